@@ -0,0 +1,567 @@
+# Pipelined acquisition engine.
+# One thread streams the raw samples from the IQ source into a ring of
+# preallocated buffers, while the calling thread converts them to IQ,
+# computes the power spectra and accumulates them.
+# This way the USB transfer never waits for the FFT,
+# and the wall time of an exposure stays close to its integration time.
+
+import numpy as np
+import threading, queue, time
+from concurrent.futures import ProcessPoolExecutor
+
+import iq_sources
+import spectral
+import fft_plans
+import rfi
+import wideband
+
+
+# [sec] maximum wait for a buffer from the reader thread
+popTimeout = 5.
+# [sec] wait between attempts to reopen the IQ source of a session
+restartDelay = 5.
+
+
+#####################################################
+# Ring of preallocated buffers
+
+class RingBuffer:
+   '''Ring of nSlot preallocated uint8 buffers,
+   each holding nSample interleaved IQ samples (2 bytes per sample).
+   The reader thread fills the free slots,
+   the consumer releases them once processed.
+   Each slot is tagged with the source generation at read time,
+   and with the sequence number of the buffer in the stream,
+   which counts the dropped buffers too, so that gaps can be located.
+   If no slot is free when new samples arrive,
+   the samples are dropped and counted, unless block is True.
+   '''
+   def __init__(self, nSlot, nSample):
+      self.buffers = np.zeros((nSlot, 2 * nSample), dtype=np.uint8)
+      self.tags = np.zeros(nSlot, dtype=int)
+      self.sequences = np.zeros(nSlot, dtype=np.int64)
+      self.nPushed = 0
+      self.free = queue.Queue()
+      self.filled = queue.Queue()
+      for iSlot in range(nSlot):
+         self.free.put(iSlot)
+      self.nDropped = 0
+
+   def push(self, data, tag=0, block=False):
+      '''Copy the raw bytes into a free slot,
+      or drop them if the consumer is lagging behind.
+      '''
+      sequence = self.nPushed
+      self.nPushed += 1
+      try:
+         iSlot = self.free.get(block=block)
+      except queue.Empty:
+         self.nDropped += 1
+         return
+      self.buffers[iSlot, :] = data
+      self.tags[iSlot] = tag
+      self.sequences[iSlot] = sequence
+      self.filled.put(iSlot)
+
+   def pop(self, timeout=None):
+      '''Return the index, content and tag of the oldest filled slot.
+      '''
+      iSlot = self.filled.get(timeout=timeout)
+      return iSlot, self.buffers[iSlot], self.tags[iSlot]
+
+   def release(self, iSlot):
+      '''Give the slot back to the reader.
+      '''
+      self.free.put(iSlot)
+
+
+def bytesToIQ(data):
+   '''Convert raw uint8 interleaved IQ bytes from the RTL-SDR
+   to complex64 samples in [-1, 1],
+   for one buffer, or for each row of a batch of buffers.
+   '''
+   iq = data.astype(np.float32).view(np.complex64)
+   iq /= 127.5
+   iq -= (1. + 1.j)
+   return iq
+
+
+#####################################################
+# Pipelined integration
+
+class Pipeline:
+   '''Stream samples from an already opened IQ source
+   into a ring of param['nRingBuffer'] buffers on a reader thread,
+   and integrate them on demand with integrate,
+   with the spectral estimator selected by param['estimator'].
+   The reader keeps streaming between calls to integrate,
+   until stop is called.
+   '''
+   def __init__(self, param, source):
+      self.param = param
+      self.source = source
+      self.ring = RingBuffer(param['nRingBuffer'], param['nSample'])
+      self.reader = None
+      self.estimator = spectral.getEstimator(param)
+      self.batch = np.zeros((param['fftBatch'], 2 * param['nSample']), dtype=np.uint8)
+      # number of buffers discarded since the last (re)tune
+      self.nSettle = 0
+
+   def start(self):
+      # Reader thread: push each buffer, tagged with the source generation
+      def callback(data):
+         self.ring.push(data, tag=self.source.generation, block=not self.source.isRealTime)
+      self.source.resume()
+      self.reader = threading.Thread(target=self.source.stream, args=(callback, 2 * self.param['nSample']), daemon=True)
+      self.reader.start()
+
+   def stop(self):
+      '''Cancel the stream, and wait until the reader thread is out of it,
+      so that the source can then be closed safely.
+      '''
+      self.source.cancel()
+      # keep releasing slots, in case the reader is blocked on a full ring
+      while self.reader.is_alive():
+         try:
+            iSlot, data, tag = self.ring.pop(timeout=0.1)
+            self.ring.release(iSlot)
+         except queue.Empty:
+            pass
+      self.reader.join()
+
+   def pop(self):
+      '''Oldest filled slot of the ring, see RingBuffer.pop.
+      Raises TimeoutError if the reader delivers nothing for popTimeout sec.
+      '''
+      try:
+         return self.ring.pop(timeout=popTimeout)
+      except queue.Empty:
+         raise TimeoutError("No samples from the IQ source for "+str(popTimeout)+" sec")
+
+   def integrate(self, frequencies, nBufferPerDwell, nBufferPerFrequency, rawFile=None):
+      '''Cycle through the schedule of center frequencies [Hz],
+      dwelling nBufferPerDwell buffers on each,
+      until nBufferPerFrequency buffers are integrated on each distinct frequency.
+      A frequency may appear several times in the schedule,
+      and consecutive identical frequencies do not cause a retune.
+      After the start and each retune, the samples read before the retune
+      and the first param['nSettleBuffer'] buffers are discarded.
+      If rawFile is given, the integrated raw bytes are also written to it,
+      and the stream index of each written buffer is returned in rawBufferIndices,
+      counted from the first one, so that the buffers dropped in between can be located.
+      The frames are grouped in blocks of param['skBuffersPerBlock'] buffers,
+      and if param['rfiExcision'] is True, the block/channel cells flagged
+      by their spectral kurtosis are dropped before averaging.
+      Returns f [Hz] relative to the center frequency,
+      the list of the mean p [V^2/Hz] for each distinct frequency,
+      in order of first appearance in the schedule,
+      and a dict with the duty cycle, dropped and discarded buffer counts,
+      the dead time spent retuning and settling, the start and stop epoch times,
+      the packed RFI mask of each block, the center frequency of each block,
+      and the fraction of frames flagged in each channel for each frequency.
+      Up to param['fftBatch'] consecutive buffers are processed together,
+      in a single batched FFT.
+      '''
+      param = self.param
+      source = self.source
+      ring = self.ring
+
+      distinctFrequencies = list(dict.fromkeys(frequencies))
+      pTot = np.zeros((len(distinctFrequencies), param['nBin']))
+      nFrame = np.zeros((len(distinctFrequencies), param['nBin']), dtype=int)
+      nFrameAll = np.zeros(len(distinctFrequencies), dtype=int)
+      nIntegrated = np.zeros(len(distinctFrequencies), dtype=int)
+      nDiscarded = 0
+      nDroppedStart = ring.nDropped
+      tRetune = 0.
+      tRetuneStart = None
+
+      iSchedule = 0
+      iFrequency = 0
+      if source.centerFrequency!=frequencies[0]:
+         source.tune(frequencies[0])
+         self.estimator.reset()
+         self.nSettle = 0
+      generation = source.generation
+      nDwell = 0
+      rawSequences = []
+
+      # blocks of frames for the RFI excision
+      sk = rfi.SKAccumulator(param['nBin'], nSigma=param['skSigma'], enabled=param['rfiExcision'],
+                             frameStride=self.estimator.skFrameStride)
+      nBlockBuffer = 0
+      masks = []
+      blockFrequencies = []
+      def closeBlock(iFrequency):
+         pSum, n, mask = sk.close()
+         pTot[iFrequency] += pSum
+         nFrame[iFrequency] += n
+         masks.append(mask)
+         blockFrequencies.append(distinctFrequencies[iFrequency])
+
+      tStart = time.time()
+      while np.any(nIntegrated < nBufferPerFrequency):
+         iSlot, data, tag = self.pop()
+         # discard samples taken before the retune, or while settling
+         if tag!=generation or self.nSettle < param['nSettleBuffer']:
+            ring.release(iSlot)
+            nDiscarded += 1
+            if tag==generation:
+               self.nSettle += 1
+            continue
+         # dead time from the retune to the first settled buffer
+         if tRetuneStart is not None:
+            tRetune += time.time() - tRetuneStart
+            tRetuneStart = None
+
+         # gather a batch of consecutive buffers, for a single batched FFT,
+         # without crossing the end of the dwell, of the SK block or of the integration
+         nBatch = min(param['fftBatch'], 
+                      param['skBuffersPerBlock'] - nBlockBuffer, 
+                      max(1, nBufferPerFrequency - nIntegrated[iFrequency]))
+         if len(frequencies) > 1:
+            nBatch = min(nBatch, nBufferPerDwell - nDwell)
+         # copy into the batch buffer, so that the ring slots are released at once
+         batch = self.batch[:nBatch]
+         batch[0] = data
+         sequences = [ring.sequences[iSlot]]
+         ring.release(iSlot)
+         for iBatch in range(1, nBatch):
+            iSlot, data, tag = self.pop()
+            batch[iBatch] = data
+            sequences.append(ring.sequences[iSlot])
+            ring.release(iSlot)
+
+         if rawFile is not None:
+            rawFile.write(batch)
+            rawSequences += sequences
+         spectra = self.estimator.spectra(bytesToIQ(batch))
+         sk.add(spectra)
+         nFrameAll[iFrequency] += spectra.shape[0]
+         nIntegrated[iFrequency] += nBatch
+         nBlockBuffer += nBatch
+         nDwell += nBatch
+         if nBlockBuffer >= param['skBuffersPerBlock']:
+            closeBlock(iFrequency)
+            nBlockBuffer = 0
+
+         # move on to the next frequency in the schedule
+         if len(frequencies) > 1 and nDwell >= nBufferPerDwell:
+            if nBlockBuffer > 0:
+               closeBlock(iFrequency)
+               nBlockBuffer = 0
+            iSchedule = (iSchedule + 1) % len(frequencies)
+            iFrequency = distinctFrequencies.index(frequencies[iSchedule])
+            nDwell = 0
+            if frequencies[iSchedule]!=source.centerFrequency:
+               tRetuneStart = time.time()
+               source.tune(frequencies[iSchedule])
+               self.estimator.reset()
+               generation = source.generation
+               self.nSettle = 0
+      if nBlockBuffer > 0:
+         closeBlock(iFrequency)
+      tStop = time.time()
+
+      # Shift frequency spectra back to the intended range
+      f = fft_plans.getFrequencyAxis(param['nBin'], param['sampleRate'])
+      p = [np.fft.fftshift(pTot[i] / nFrame[i]) for i in range(len(distinctFrequencies))]
+
+      # Achieved duty cycle: fraction of the wall time actually integrated
+      stats = {}
+      stats['nProcessedBuffers'] = int(np.sum(nIntegrated))
+      stats['nDroppedBuffers'] = ring.nDropped - nDroppedStart
+      stats['nDiscardedBuffers'] = nDiscarded
+      stats['retuneTime'] = tRetune
+      stats['dutyCycle'] = np.sum(nIntegrated) * param['nSample'] / param['sampleRate'] / (tStop - tStart)
+      stats['timeStartEpoch'] = tStart
+      stats['timeStopEpoch'] = tStop
+      # RFI masks, with the channels in the same order as p
+      stats['rfiMaskPacked'] = np.packbits(np.fft.fftshift(np.array(masks), axes=-1), axis=-1)
+      stats['rfiBlockFrequencies'] = np.array(blockFrequencies)
+      stats['rfiFlagFraction'] = np.fft.fftshift(1. - nFrame / nFrameAll[:, np.newaxis], axes=-1)
+      if rawFile is not None:
+         stats['rawBufferIndices'] = np.array(rawSequences, dtype=np.int64) - (rawSequences[0] if rawSequences else 0)
+      return f, p, stats
+
+
+def printStats(stats):
+   print("Processed "+str(stats['nProcessedBuffers'])+" buffers, dropped "+str(stats['nDroppedBuffers'])+", discarded "+str(stats['nDiscardedBuffers']))
+   print("Achieved duty cycle is "+str(round(stats['dutyCycle']*100.))+"%")
+   print("Flagged "+str(round(np.mean(stats['rfiFlagFraction'])*100., 2))+"% of the data as RFI")
+
+
+def runPipeline(param, source, frequencies, nBufferPerDwell, nBufferPerFrequency, rawFile=None):
+   '''Stream and integrate samples from the already opened IQ source,
+   with a reader thread started and stopped here.
+   See Pipeline.integrate.
+   Returns f [Hz] and the list of the mean p [V^2/Hz] for each frequency,
+   and adds the integration statistics to param.
+   '''
+   pipeline = Pipeline(param, source)
+   pipeline.start()
+   try:
+      f, p, stats = pipeline.integrate(frequencies, nBufferPerDwell, nBufferPerFrequency, rawFile=rawFile)
+   finally:
+      pipeline.stop()
+   param.update(stats)
+   printStats(stats)
+   return f, p
+
+
+def runSpectrumPipelined(param, centerFrequency, source=None, rawFile=None):
+   '''Integrate a power spectrum at centerFrequency [Hz]
+   for param['integrationTime'] [sec].
+   The source is opened and closed here, unless it is provided.
+   If rawFile is given, the raw IQ bytes are also recorded to it.
+   Returns f [Hz], p [V^2/Hz].
+   '''
+   # number of buffers needed to reach the integration time
+   nBuffer = int(np.ceil(param['integrationTime'] * param['sampleRate'] / param['nSample']))
+
+   ownSource = source is None
+   if ownSource:
+      source = iq_sources.getSource(param, centerFrequency=centerFrequency)
+      source.open()
+   try:
+      # runPipeline stops and joins its reader thread, even on a timeout,
+      # before the source is closed
+      f, p = runPipeline(param, source, [centerFrequency], nBuffer, nBuffer, rawFile=rawFile)
+   finally:
+      if ownSource:
+         source.close()
+   return fft_plans.getFrequencyAxis(param['nBin'], param['sampleRate'], centerFrequency), p[0]
+
+
+def runFswitchPipelined(param, source=None):
+   '''Integrate power spectra alternating between
+   param['centerFrequency'] and param['throwFrequency'] [Hz]
+   at param['alternatingFrequency'] [Hz].
+   As with rtlobs, the integration time is split between both frequencies.
+   Returns fOn, pOn, fOff, pOff.
+   '''
+   nBuffer = int(np.ceil(0.5 * param['integrationTime'] * param['sampleRate'] / param['nSample']))
+   # number of buffers in half a switching period
+   nBufferPerDwell = max(1, int(round(0.5 / param['alternatingFrequency'] * param['sampleRate'] / param['nSample'])))
+
+   ownSource = source is None
+   if ownSource:
+      source = iq_sources.getSource(param)
+      source.open()
+   try:
+      f, p = runPipeline(param, source, [param['centerFrequency'], param['throwFrequency']], nBufferPerDwell, nBuffer)
+   finally:
+      if ownSource:
+         source.close()
+   fOn = fft_plans.getFrequencyAxis(param['nBin'], param['sampleRate'], param['centerFrequency'])
+   fOff = fft_plans.getFrequencyAxis(param['nBin'], param['sampleRate'], param['throwFrequency'])
+   return fOn, p[0], fOff, p[1]
+
+
+def runWidebandPipelined(param, source=None):
+   '''Integrate power spectra hopping across the overlapping
+   center frequencies of wideband.getHopFrequencies,
+   dwelling param['hopDwellTime'] [sec] on each.
+   The hops are visited back and forth (0, 1, ..., N-1, N-1, ..., 0),
+   so that each retune is a single short step,
+   and the end frequencies are visited twice in a row without retuning.
+   The integration time is split between all hop frequencies.
+   Returns the hop frequencies [Hz], and the arrays fHops [Hz], pHops [V^2/Hz]
+   with one row per hop.
+   '''
+   hopFrequencies = wideband.getHopFrequencies(param)
+   nHop = len(hopFrequencies)
+   nBuffer = int(np.ceil(param['integrationTime'] / nHop * param['sampleRate'] / param['nSample']))
+   nBufferPerDwell = max(1, int(round(param['hopDwellTime'] * param['sampleRate'] / param['nSample'])))
+   schedule = list(hopFrequencies) + list(hopFrequencies[::-1])
+
+   ownSource = source is None
+   if ownSource:
+      source = iq_sources.getSource(param, centerFrequency=hopFrequencies[0])
+      source.open()
+   try:
+      f, p = runPipeline(param, source, schedule, nBufferPerDwell, nBuffer)
+   finally:
+      if ownSource:
+         source.close()
+   fHops = np.array([fft_plans.getFrequencyAxis(param['nBin'], param['sampleRate'], hopFrequency) for hopFrequency in hopFrequencies])
+   print("Time spent retuning and settling is "+str(round(param['retuneTime'], 2))+" sec")
+   return hopFrequencies, fHops, np.array(p)
+
+
+#####################################################
+# Multiple dongles
+
+# integration statistics returned by each dongle, including its RFI masks
+deviceStatsKeys = ['nProcessedBuffers', 'nDroppedBuffers', 'nDiscardedBuffers', 'dutyCycle',
+                   'rfiMaskPacked', 'rfiBlockFrequencies', 'rfiFlagFraction']
+
+
+def integrateDevice(param, deviceIndex, centerFrequency):
+   '''Integrate a power spectrum at centerFrequency [Hz]
+   on the dongle deviceIndex.
+   Runs in its own worker process.
+   Returns f [Hz], p [V^2/Hz] and the integration statistics deviceStatsKeys.
+   '''
+   paramDevice = dict(param)
+   paramDevice['deviceIndex'] = deviceIndex
+   f, p = runSpectrumPipelined(paramDevice, centerFrequency)
+   stats = {key: paramDevice[key] for key in deviceStatsKeys}
+   return f, p, stats
+
+
+def runMultiDevice(param, deviceIndices, frequencies):
+   '''Integrate simultaneously on all the dongles in deviceIndices,
+   each tuned to the corresponding center frequency [Hz] in frequencies,
+   with one worker process per dongle, so that the FFTs run in parallel.
+   Returns the list of (f, p, stats), in the order of deviceIndices.
+   '''
+   with ProcessPoolExecutor(max_workers=len(deviceIndices)) as pool:
+      futures = [pool.submit(integrateDevice, param, deviceIndex, frequency)
+                 for deviceIndex, frequency in zip(deviceIndices, frequencies)]
+      return [future.result() for future in futures]
+
+
+#####################################################
+# Continuous session
+
+class AcquisitionSession:
+   '''Keep the IQ source open and streaming across exposures.
+   An integration thread cuts the stream into consecutive slices
+   of param['integrationTime'] at param['centerFrequency'],
+   back to back, so that consecutive exposures have almost no gap.
+   The slices are retrieved in order with nextSpectrum.
+   pause and resume free the IQ source for other exposures in between.
+   If onSliceStart is given, it is called at the start of each slice,
+   on a side thread so that the stream keeps being integrated,
+   and the dict it returns, e.g. the mount pointing, is added to the slice statistics.
+   '''
+   def __init__(self, param, onSliceStart=None):
+      self.param = dict(param)
+      self.nBuffer = int(np.ceil(param['integrationTime'] * param['sampleRate'] / param['nSample']))
+      self.onSliceStart = onSliceStart
+      self.results = queue.Queue()
+      self.running = True
+
+      self.source = iq_sources.getSource(self.param)
+      self.source.open()
+      self.pipeline = Pipeline(self.param, self.source)
+      self.pipeline.start()
+      self.integrator = threading.Thread(target=self.run, daemon=True)
+      self.integrator.start()
+
+   def restart(self):
+      '''Reopen the IQ source and restart the stream,
+      e.g. after a USB hiccup or a stalled stream.
+      '''
+      self.pipeline.stop()
+      self.source.close()
+      self.source = iq_sources.getSource(self.param)
+      self.source.open()
+      self.pipeline = Pipeline(self.param, self.source)
+      self.pipeline.start()
+
+   def integrateSlice(self):
+      '''Integrate the next slice.
+      Returns f [Hz], p [V^2/Hz] and the statistics of the slice.
+      '''
+      sliceInfo = {}
+      if self.onSliceStart is not None:
+         def readSliceInfo():
+            try:
+               sliceInfo.update(self.onSliceStart())
+            except Exception as e:
+               print("Could not read the slice information: "+str(e))
+         infoReader = threading.Thread(target=readSliceInfo, daemon=True)
+         infoReader.start()
+      f, p, stats = self.pipeline.integrate([self.param['centerFrequency']], self.nBuffer, self.nBuffer)
+      if self.onSliceStart is not None:
+         infoReader.join()
+         stats.update(sliceInfo)
+      f = fft_plans.getFrequencyAxis(self.param['nBin'], self.param['sampleRate'], self.param['centerFrequency'])
+      return f, p[0], stats
+
+   def reopen(self):
+      '''Restart the IQ source, until it succeeds or close is called.
+      '''
+      while self.running:
+         try:
+            self.restart()
+            return
+         except Exception as e:
+            print("Could not restart the IQ source: "+str(e))
+            time.sleep(restartDelay)
+
+   def run(self, reopen=False):
+      '''Integrate slices until close is called,
+      after reopening the IQ source if reopen is True.
+      An error is passed on to nextSpectrum,
+      then the IQ source is reopened, until it succeeds or close is called,
+      so that the session survives a USB hiccup or a stalled stream.
+      '''
+      if reopen:
+         self.reopen()
+      while self.running:
+         try:
+            self.results.put(self.integrateSlice())
+         except Exception as e:
+            if not self.running:
+               return
+            print("Session slice failed: "+str(e)+". Restarting the IQ source")
+            self.results.put(e)
+            self.reopen()
+
+   def nextSpectrum(self, param):
+      '''Wait for the next slice of the stream.
+      Returns f [Hz], p [V^2/Hz], and adds the integration statistics to param,
+      with the start time of the slice in param['timeStartEpoch'].
+      Raises the error of the slice if it failed,
+      or TimeoutError if no slice arrives in time, e.g. while the source cannot be reopened.
+      '''
+      if param['integrationTime']!=self.param['integrationTime']:
+         print("Session integration time is "+str(self.param['integrationTime'])+" sec")
+      # a slice takes the integration time, plus the time to fill the pipeline
+      tTimeout = time.time() + 2. * self.param['integrationTime'] + 2. * popTimeout
+      while True:
+         try:
+            result = self.results.get(timeout=1.)
+            break
+         except queue.Empty:
+            if not self.integrator.is_alive():
+               raise RuntimeError("The session integration thread has stopped")
+            if time.time() > tTimeout:
+               raise TimeoutError("No spectrum from the session for "+str(round(2. * self.param['integrationTime'] + 2. * popTimeout))+" sec")
+      if isinstance(result, Exception):
+         raise result
+      f, p, stats = result
+      param.update(stats)
+      printStats(stats)
+      return f, p
+
+   def close(self):
+      '''Stop streaming and close the IQ source.
+      '''
+      self.running = False
+      # stopping the stream interrupts the slice being integrated
+      self.pipeline.stop()
+      self.integrator.join()
+      # in case the stream was restarted meanwhile
+      self.pipeline.stop()
+      self.source.close()
+
+   def pause(self):
+      '''Stop streaming and close the IQ source,
+      e.g. to free the dongle for an exposure the session cannot take.
+      The slices not yet retrieved are dropped.
+      '''
+      self.close()
+
+   def resume(self):
+      '''Reopen the IQ source and stream again after pause.
+      The source is reopened by the integration thread,
+      which keeps trying if the dongle is not available yet.
+      '''
+      self.results = queue.Queue()
+      self.running = True
+      self.integrator = threading.Thread(target=self.run, args=(True,), daemon=True)
+      self.integrator.start()
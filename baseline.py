@@ -0,0 +1,96 @@
+# Baseline (bandpass) fitting of many spectra at once.
+# The baseline is a linear combination of smooth basis functions of frequency,
+# Legendre polynomials or cubic B-splines, fitted by least squares
+# to the channels outside of a window around the 21cm line.
+# For a given frequency axis, basis and line window,
+# the pseudo-inverse of the design matrix is computed once and cached,
+# so that fitting a whole (nSpectrum, nBin) stack is a single matrix product.
+
+import numpy as np
+from scipy.interpolate import BSpline
+import hashlib
+
+
+# 21cm line rest-frame frequency
+nu21cm = 1420405751.768 # [Hz]
+
+# fitters already built, by configuration
+fitterCache = {}
+
+
+def getDesignMatrix(f, kind='poly', order=3, nKnot=6):
+   '''Basis functions (nBin, nParam) evaluated at the frequencies f [Hz]:
+   for kind 'poly', Legendre polynomials up to order, on the band mapped to [-1, 1];
+   for kind 'spline', cubic B-splines with nKnot uniform interior knots.
+   '''
+   x = 2. * (f - f[0]) / (f[-1] - f[0]) - 1.
+   if kind=='poly':
+      return np.polynomial.legendre.legvander(x, order)
+   elif kind=='spline':
+      k = 3
+      interior = np.linspace(-1., 1., nKnot + 2)
+      knots = np.concatenate(([-1.] * k, interior, [1.] * k))
+      return BSpline.design_matrix(np.clip(x, -1., 1.), knots, k).toarray()
+   else:
+      raise ValueError("Unknown baseline kind "+str(kind))
+
+
+def getLineMask(f, lineHalfWidth=0.4e6, lineFrequency=nu21cm):
+   '''True for the channels used in the fit,
+   i.e. further than lineHalfWidth [Hz] from lineFrequency [Hz].
+   '''
+   return np.abs(f - lineFrequency) > lineHalfWidth
+
+
+class BaselineFitter:
+   '''Least-squares baseline fit on a fixed frequency axis f [Hz],
+   excluding the line window.
+   '''
+   def __init__(self, f, kind='poly', order=3, nKnot=6, lineHalfWidth=0.4e6, lineFrequency=nu21cm):
+      self.f = np.array(f, dtype=np.float64)
+      self.A = getDesignMatrix(self.f, kind, order, nKnot)
+      self.mask = getLineMask(self.f, lineHalfWidth, lineFrequency)
+      if np.sum(self.mask) < self.A.shape[1]:
+         raise ValueError("Not enough channels outside of the line window for the baseline fit")
+      # pseudo-inverse restricted to the fitted channels (nParam, nFit)
+      self.pinv = np.linalg.pinv(self.A[self.mask])
+
+   def fit(self, p):
+      '''Fit the baselines of the spectra p, (nBin,) or (nSpectrum, nBin).
+      Returns the baselines, same shape as p,
+      and the rms of the residuals p - baseline over the fitted channels,
+      one per spectrum.
+      '''
+      p = np.asarray(p, dtype=np.float64)
+      coefficients = p[..., self.mask] @ self.pinv.T # (..., nParam)
+      baseline = coefficients @ self.A.T
+      residual = (p - baseline)[..., self.mask]
+      rms = np.sqrt(np.mean(residual**2, axis=-1))
+      return baseline, rms
+
+
+def getFitter(f, kind='poly', order=3, nKnot=6, lineHalfWidth=0.4e6, lineFrequency=nu21cm):
+   '''BaselineFitter for this configuration, built once then cached.
+   '''
+   f = np.ascontiguousarray(f, dtype=np.float64)
+   key = (hashlib.sha1(f.tobytes()).hexdigest(), kind, order, nKnot, lineHalfWidth, lineFrequency)
+   if key not in fitterCache:
+      fitterCache[key] = BaselineFitter(f, kind, order, nKnot, lineHalfWidth, lineFrequency)
+   return fitterCache[key]
+
+
+def fitBaseline(f, p, kind='poly', order=3, nKnot=6, lineHalfWidth=0.4e6, lineFrequency=nu21cm):
+   '''Fit the baselines of the spectra p, (nBin,) or (nSpectrum, nBin),
+   at the frequencies f [Hz], with the cached fitter.
+   Returns the baselines and the rms of the residuals, see BaselineFitter.fit.
+   '''
+   return getFitter(f, kind, order, nKnot, lineHalfWidth, lineFrequency).fit(p)
+
+
+def removeBaseline(f, p, **kwargs):
+   '''Spectra p divided by their fitted baseline, minus 1,
+   i.e. the fractional excess over the bandpass, e.g. the 21cm line.
+   Also returns the rms of the fit residuals.
+   '''
+   baseline, rms = fitBaseline(f, p, **kwargs)
+   return p / baseline - 1., rms
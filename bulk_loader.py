@@ -0,0 +1,196 @@
+# Parallel loading of many exposures at once, for the analysis notebooks.
+# The files are read and parsed concurrently in a process pool,
+# and the spectra are returned pre-stacked as (nExposure, nBin) arrays,
+# with the metadata of each exposure aligned on the same rows.
+# Supported formats:
+# - .npz and .json exposures from diy21cm.saveJson (npz_io, json_io)
+# - legacy .txt exposures from np.savetxt, e.g. *_reduced.txt,
+#   with their "key = value" header lines.
+
+import numpy as np
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import json_io
+import npz_io
+import pyramid
+
+
+# legacy txt header entries with a diy21cm name
+txtHeaderNames = {'Capture date': 'dateCapture',
+                  'Capture time': 'timeCapture',
+                  'sample rate': 'sampleRate'}
+
+
+def loadTxt(path):
+   '''Load a legacy txt exposure.
+   Returns a dict with the header entries "key = value # comment",
+   and the columns of the file in 'data', as an array (nBin, nColumn).
+   '''
+   param = {}
+   with open(path, 'r') as f:
+      for line in f:
+         if not line.startswith('#'):
+            break
+         line = line[1:].split('#')[0]
+         if '=' in line:
+            key, value = [x.strip() for x in line.split('=', 1)]
+            key = txtHeaderNames.get(key, key)
+            # the date and time stay strings, as in diy21cm
+            try:
+               param[key] = value if key in ['dateCapture', 'timeCapture'] else float(value)
+            except ValueError:
+               param[key] = value
+   param['data'] = np.loadtxt(path)
+   return param
+
+
+def loadFile(path, keys, nPixel=None):
+   '''Load one exposure, in any supported format,
+   and only keep the arrays in keys, plus all the scalar metadata.
+   If nPixel is given, each array is rebinned to the coarsest power of 2 level
+   with at least nPixel channels, read from the saved level if any, see pyramid.getLevelArray.
+   Runs in the worker processes.
+   '''
+   if path.endswith('.txt'):
+      exposure = loadTxt(path)
+   elif path.endswith('.npz'):
+      exposure = npz_io.LazyExposure(path)
+   else:
+      exposure = json_io.loadJson(path)
+   if path.endswith('.npz'):
+      header = dict(exposure.header)
+   else:
+      header, arrays = npz_io.split_dict(exposure)
+      exposure = arrays
+   # only read the selected arrays
+   arrays = {}
+   for key in keys:
+      if key in exposure:
+         arrays[key] = np.array(exposure[key] if nPixel is None else pyramid.getLevelArray(exposure, key, nPixel))
+   return header, arrays
+
+
+def isSelected(path, header, perDevice):
+   '''True if the file at path, with the scalar parameters header, is an exposure,
+   and is a per-dongle copy of a multi-dongle exposure only if perDevice is True,
+   see diy21cm.splitDevices.
+   Legacy txt exposures have no expType, and are always kept.
+   '''
+   if path.endswith('.txt'):
+      return True
+   return 'expType' in header and bool(header.get('perDevice', False))==perDevice
+
+
+def loadExposures(paths, keys=['fOn', 'pOn'], nWorker=None, nPixel=None, perDevice=None):
+   '''Load all the exposure files in paths, in parallel on nWorker processes
+   (all the cores if None).
+   keys are the arrays to stack, e.g. ['fOn', 'pOn'], or ['data'] for txt files.
+   If nPixel is given, e.g. the width of an overview plot,
+   only the coarsest saved level with at least nPixel channels is read.
+   If perDevice is not None, the files that are not exposures, e.g. the waterfall headers,
+   are skipped, and so are the per-dongle copies of multi-dongle exposures, unless perDevice is True,
+   in which case only those are kept, as in catalog.query.
+   Returns a dict of stacked arrays, one per key, of shape (nExposure, ...),
+   and a dict of metadata columns, e.g. metadata['timeCapture'][i],
+   both in the order of paths, plus metadata['path'].
+   Missing scalar metadata are None.
+   '''
+   paths = list(paths)
+   if len(paths)==0:
+      return {}, {'path': []}
+   chunkSize = max(1, len(paths) // (4 * (nWorker or os.cpu_count() or 1)))
+   with ProcessPoolExecutor(max_workers=nWorker) as pool:
+      results = list(pool.map(partial(loadFile, keys=keys, nPixel=nPixel), paths, chunksize=chunkSize))
+
+   if perDevice is not None:
+      selected = [isSelected(path, header, perDevice) for path, (header, arrays) in zip(paths, results)]
+      paths = [path for path, keep in zip(paths, selected) if keep]
+      results = [result for result, keep in zip(results, selected) if keep]
+      if len(paths)==0:
+         return {}, {'path': []}
+
+   # stack the arrays
+   stacks = {}
+   for key in keys:
+      missing = [path for path, (header, arrays) in zip(paths, results) if key not in arrays]
+      if missing:
+         raise KeyError(key+" is missing from "+missing[0])
+      stacks[key] = np.stack([arrays[key] for header, arrays in results])
+
+   # align the metadata
+   metadataNames = []
+   for header, arrays in results:
+      metadataNames += [name for name in header if name not in metadataNames]
+   metadata = {name: [header.get(name) for header, arrays in results] for name in metadataNames}
+   metadata['path'] = paths
+   return stacks, metadata
+
+
+# exposure formats, by order of precedence when an exposure is saved in several
+extensions = ['.npz', '.json', '.txt']
+
+
+def listExposures(directory, contains=None, extension=None):
+   '''Sorted paths of the exposure files in directory,
+   containing the string contains if given,
+   excluding the "latest" copies, as in the notebooks,
+   and the sidecar headers of raw IQ recordings.
+   If extension is None, each exposure is listed once, in the first format
+   of extensions that exists, as in npz_io.findExposure,
+   else only the files with the extension are listed.
+   '''
+   paths = {}
+   for f in os.listdir(directory):
+      stem, fileExtension = os.path.splitext(f)
+      if (extension is None and fileExtension not in extensions) or (extension is not None and not f.endswith(extension)):
+         continue
+      if (contains is not None and contains not in f) or f.startswith('latest') or f.endswith('.iq.json'):
+         continue
+      # keep the preferred format of each stem
+      if stem not in paths or (extension is None and extensions.index(fileExtension) < extensions.index(os.path.splitext(paths[stem])[1])):
+         paths[stem] = f
+   return sorted([os.path.join(directory, f) for f in paths.values()])
+
+
+def loadDirectory(directory, contains=None, extension=None, keys=['fOn', 'pOn'], nWorker=None, nPixel=None,
+                  perDevice=False):
+   '''Load all the exposures of a folder, in any format, e.g.
+   loadDirectory('./output/20250525', contains='exposure_on')
+   or, for the legacy reduced txt files:
+   loadDirectory(pathOut, contains='reduced', extension='.txt', keys=['data'])
+   The other files, e.g. the waterfall headers, are skipped,
+   and so are the per-dongle copies of multi-dongle exposures, unless perDevice is True, see loadExposures.
+   '''
+   return loadExposures(listExposures(directory, contains, extension), keys=keys, nWorker=nWorker, nPixel=nPixel,
+                        perDevice=perDevice)
+
+
+def loadQuery(rows, keys=['fOn', 'pOn'], nWorker=None, nPixel=None):
+   '''Load the exposures selected by a catalog query, e.g.
+   loadQuery(catalog.query(pathCatalog, expType='on', hasHotReference=True))
+   '''
+   return loadExposures([row['path'] for row in rows], keys=keys, nWorker=nWorker, nPixel=nPixel)
+
+
+
+
+#####################################################
+#####################################################
+#####################################################
+
+if __name__=="__main__":
+
+   import sys, time
+
+   # Load all the on exposures of a folder, e.g.
+   # python bulk_loader.py ./output/20250525
+   # or only the json files:
+   # python bulk_loader.py ./output/20250525 .json
+   directory = sys.argv[1] if len(sys.argv) > 1 else './output'
+   extension = sys.argv[2] if len(sys.argv) > 2 else None
+   tStart = time.time()
+   stacks, metadata = loadDirectory(directory, contains='exposure_on', extension=extension)
+   print("Loaded "+str(len(metadata['path']))+" exposures in "+str(round(time.time() - tStart, 2))+" sec")
+   for key, stack in stacks.items():
+      print(key+": "+str(stack.shape))
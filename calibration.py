@@ -0,0 +1,185 @@
+# In-memory cache of the hot/cold calibration references.
+# attemptCalibration needs the latest hot and cold spectra for every exposure.
+# Rather than re-reading the "latest" files each time,
+# the spectra are kept in memory, with the modification time and size
+# of the file they came from, and only re-read when the file changes,
+# e.g. when another process takes a new hot/cold exposure.
+# New hot/cold exposures saved by this process feed the cache directly.
+# The "latest" files are replaced atomically (see diy21cm.saveExposure),
+# so a reader never sees a partially written file.
+# The batch calibration calibrates a whole stack of exposures at once,
+# with the hot/cold references interpolated in time,
+# to follow the drift of the receiver gain during the night.
+
+import numpy as np
+import os, threading
+import npz_io
+import catalog
+import bulk_loader
+
+
+# physical temperatures of the references
+tHot = 300. # [K]
+tCold = 20. # [K]
+
+
+#####################################################
+# Calibration formulas, vectorized
+
+def calibrateHotCold(p, pH, pC, tH, tC):
+   '''compute calibrated temperature spectum t [K]
+   from power spectra p, pH, pC [any unit]
+   measured at temperatures t, tH, tC [K].
+   Assumes
+   p = factor * (t + tOffset)
+   Broadcasts, e.g. p (nExposure, nBin) with pH, pC (nBin,) or (nExposure, nBin).
+   '''
+   # Solve for affine parameters
+   factor = (pH - pC) / (tH - tC)  # [dimless]
+   tOffset = (tH * pC - tC * pH) / (pH - pC) # [K]
+   # invert the power to temperature relation
+   t = p / factor - tOffset   # [K]
+   return t
+
+
+def calibratePartial(p, pRef, tRef):
+   '''compute partially-calibrated temperature spectrum t [K]
+   from power spectrum p [au],
+   based on a reference power spectrum pRef [au]
+   measured at temperature tRef [K].
+   Assumes
+   p = factor * t
+   Broadcasts like calibrateHotCold.
+   '''
+   t = tRef * p / pRef  # [K]
+   return t
+
+
+#####################################################
+# Batch calibration
+
+def interpolateReferences(time, timeRef, pRef):
+   '''Reference spectra pRef (nRef, nBin), taken at the times timeRef (nRef,) [sec],
+   linearly interpolated at the times time (nExposure,) [sec].
+   Before the first and after the last reference, the nearest one is used.
+   Returns an array (nExposure, nBin).
+   '''
+   time = np.atleast_1d(np.asarray(time, dtype=np.float64))
+   timeRef = np.atleast_1d(np.asarray(timeRef, dtype=np.float64))
+   pRef = np.atleast_2d(pRef)
+   if len(timeRef)==1:
+      return np.broadcast_to(pRef[0], (len(time), pRef.shape[1]))
+   order = np.argsort(timeRef)
+   timeRef = timeRef[order]
+   pRef = pRef[order]
+   # bracketing references, and interpolation weights
+   i = np.clip(np.searchsorted(timeRef, time), 1, len(timeRef) - 1)
+   w = np.clip((time - timeRef[i - 1]) / (timeRef[i] - timeRef[i - 1]), 0., 1.)[:, np.newaxis]
+   return (1. - w) * pRef[i - 1] + w * pRef[i]
+
+
+def calibrateBatch(p, time, timeHot=None, pHot=None, timeCold=None, pCold=None, tH=tHot, tC=tCold):
+   '''Calibrate the stack of spectra p (nExposure, nBin) taken at the times time (nExposure,) [sec],
+   against any number of hot and/or cold references pHot, pCold (nRef, nBin)
+   taken at the times timeHot, timeCold (nRef,) [sec].
+   The references are interpolated in time, so the receiver gain and offset
+   follow their drift between references.
+   Returns the temperatures t (nExposure, nBin) [K],
+   and the calibration type 'HotCold', 'Hot' or 'Cold', as in the tCalibrated* keys.
+   '''
+   p = np.atleast_2d(p)
+   if pHot is not None and pCold is not None:
+      pH = interpolateReferences(time, timeHot, pHot)
+      pC = interpolateReferences(time, timeCold, pCold)
+      return calibrateHotCold(p, pH, pC, tH, tC), 'HotCold'
+   elif pCold is not None:
+      return calibratePartial(p, interpolateReferences(time, timeCold, pCold), tC), 'Cold'
+   elif pHot is not None:
+      return calibratePartial(p, interpolateReferences(time, timeHot, pHot), tH), 'Hot'
+   else:
+      raise ValueError("No hot or cold reference to calibrate with")
+
+
+def calibrateDirectory(directory, extension=None, nWorker=None, nPixel=None):
+   '''Load all the on, hot and cold exposures of an output folder,
+   e.g. ./output/20250525, with bulk_loader,
+   and calibrate all the on exposures at once with calibrateBatch.
+   Returns the frequencies fOn (nExposure, nBin) [Hz], the temperatures (nExposure, nBin) [K],
+   the calibration type, and the metadata of the on exposures,
+   with their times in metadata['timeEpoch'].
+   '''
+   stacks = {}
+   times = {}
+   metadata = {}
+   for expType in ['on', 'hot', 'cold']:
+      # without the per-dongle copies of multi-dongle exposures
+      paths = bulk_loader.listExposures(directory, contains='exposure_'+expType+'_', extension=extension)
+      stacksType, metadataType = bulk_loader.loadExposures(paths, nWorker=nWorker, nPixel=nPixel, perDevice=False)
+      nExposure = len(metadataType['path'])
+      if nExposure > 0:
+         stacks[expType], metadata[expType] = stacksType, metadataType
+         rows = [{name: metadata[expType][name][i] for name in metadata[expType]} for i in range(nExposure)]
+         times[expType] = np.array([catalog.getTimeEpoch(row) for row in rows])
+         metadata[expType]['timeEpoch'] = times[expType]
+   if 'on' not in stacks:
+      raise ValueError("No on exposure in "+directory)
+
+   t, calibrationType = calibrateBatch(stacks['on']['pOn'], times['on'],
+                                       timeHot=times.get('hot'), pHot=stacks['hot']['pOn'] if 'hot' in stacks else None,
+                                       timeCold=times.get('cold'), pCold=stacks['cold']['pOn'] if 'cold' in stacks else None)
+   return stacks['on']['fOn'], t, calibrationType, metadata['on']
+
+
+def getSignature(path):
+   '''Modification time [ns] and size [bytes] of the file,
+   which change whenever the file is replaced.
+   '''
+   stat = os.stat(path)
+   return stat.st_mtime_ns, stat.st_size
+
+
+class ReferenceCache:
+   '''Reference spectra pOn of the latest hot/cold exposures,
+   by path stem (without extension), e.g. ./output/20250525/latest_exposure_hot_300sec.
+   The npz file is preferred over the json file.
+   '''
+   def __init__(self):
+      self.entries = {}
+      self.lock = threading.Lock()
+
+   def get(self, pathStem):
+      '''Reference spectrum of the exposure pathStem,
+      or None if it does not exist.
+      Only a stat of the file, unless it changed since it was cached.
+      '''
+      path = npz_io.findExposure(pathStem)
+      if path is None:
+         return None
+      signature = getSignature(path)
+      with self.lock:
+         entry = self.entries.get(pathStem)
+         if entry is not None and entry['path']==path and entry['signature']==signature:
+            return entry['p']
+      # (re-)load outside of the lock, copied out of the file
+      p = np.array(npz_io.LazyExposure(path)['pOn'])
+      p.flags.writeable = False
+      with self.lock:
+         self.entries[pathStem] = {'path': path, 'signature': signature, 'p': p}
+      return p
+
+   def put(self, pathStem, path, p):
+      '''Feed the reference spectrum p just saved at path,
+      so that it does not need to be read back.
+      '''
+      p = np.array(p)
+      p.flags.writeable = False
+      with self.lock:
+         self.entries[pathStem] = {'path': path, 'signature': getSignature(path), 'p': p}
+
+   def clear(self):
+      with self.lock:
+         self.entries = {}
+
+
+# one cache per process
+referenceCache = ReferenceCache()
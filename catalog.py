@@ -0,0 +1,220 @@
+# SQLite catalog of all the saved exposures.
+# Each exposure file gets one row with its main scalar parameters,
+# so that exposures can be selected by type, date, time of capture,
+# pointing, etc. with an indexed query,
+# instead of listing the output folders and parsing the file names.
+# The catalog is updated by diy21cm.saveJson,
+# and can be rebuilt from an existing output tree:
+# python catalog.py rebuild ./output
+
+import sqlite3
+import numpy as np
+import os, sys
+from datetime import datetime, timedelta
+import npz_io
+
+
+# columns of the catalog, and their sqlite types
+columns = [('path', 'TEXT PRIMARY KEY'),
+           ('fileName', 'TEXT'),
+           ('dateCapture', 'TEXT'),
+           ('timeCapture', 'TEXT'),
+           ('timeEpoch', 'REAL'), # [sec] since the Unix epoch
+           ('hourCapture', 'REAL'), # [hour] since midnight of dateCapture, may exceed 24 in long loops
+           ('expType', 'TEXT'),
+           ('integrationTime', 'REAL'), # [sec]
+           ('ra', 'REAL'), # [hour], as read from INDI
+           ('dec', 'REAL'), # [deg]
+           ('lat', 'REAL'), # [deg]
+           ('lon', 'REAL'), # [deg]
+           ('gain', 'REAL'), # [dB]
+           ('centerFrequency', 'REAL'), # [Hz]
+           ('deviceIndex', 'INTEGER'),
+           ('perDevice', 'INTEGER')] # 1 for the per-dongle copies of a multi-dongle exposure, see diy21cm.splitDevices
+columnNames = [name for name, sqlType in columns]
+
+indices = {'iExpTypeHour': ['expType', 'hourCapture'],
+           'iExpTypeEpoch': ['expType', 'timeEpoch'],
+           'iDate': ['dateCapture'],
+           'iRaDec': ['ra', 'dec']}
+
+
+def connect(pathCatalog):
+   '''Open the catalog, creating it if needed.
+   '''
+   folder = os.path.dirname(pathCatalog)
+   if folder and not os.path.exists(folder):
+      os.makedirs(folder)
+   connection = sqlite3.connect(pathCatalog, timeout=30.)
+   connection.row_factory = sqlite3.Row
+   connection.execute("CREATE TABLE IF NOT EXISTS exposures ("
+                      +", ".join(name+" "+sqlType for name, sqlType in columns)+")")
+   # add the columns missing from an older catalog
+   existing = [row['name'] for row in connection.execute("PRAGMA table_info(exposures)")]
+   for name, sqlType in columns:
+      if name not in existing:
+         connection.execute("ALTER TABLE exposures ADD COLUMN "+name+" "+sqlType)
+   for indexName, indexColumns in indices.items():
+      connection.execute("CREATE INDEX IF NOT EXISTS "+indexName
+                         +" ON exposures ("+", ".join(indexColumns)+")")
+   return connection
+
+
+#####################################################
+# Rows
+
+def getHourCapture(timeCapture):
+   '''Hours since midnight [hour], from a time string 'hhhmmmsss',
+   as set by diy21cm.setTime or setTimeSameDate.
+   '''
+   hours, rest = timeCapture.split('h')
+   minutes, rest = rest.split('m')
+   seconds = rest.rstrip('s')
+   return int(hours) + int(minutes) / 60. + int(seconds) / 3600.
+
+
+def getTimeEpoch(param):
+   '''Time of capture [sec] since the Unix epoch,
+   recomputed from the date and time of capture
+   for older exposures that do not have timeEpoch.
+   '''
+   if param.get('timeEpoch') is not None:
+      return param['timeEpoch']
+   start = datetime.strptime(param['dateCapture'], "%Y%m%d")
+   return (start + timedelta(hours=getHourCapture(param['timeCapture']))).timestamp()
+
+
+def getRow(param, path):
+   '''Catalog row of the exposure param saved at path.
+   '''
+   row = {name: param.get(name) for name in columnNames}
+   row['path'] = os.path.normpath(path)
+   row['hourCapture'] = getHourCapture(param['timeCapture'])
+   row['timeEpoch'] = getTimeEpoch(param)
+   row['perDevice'] = int(bool(param.get('perDevice', False)))
+   # nan from a missing mount is stored as NULL
+   for name in ['ra', 'dec', 'lat', 'lon']:
+      if row[name] is not None and not np.isfinite(row[name]):
+         row[name] = None
+   return row
+
+
+def insertRows(connection, rows):
+   connection.executemany("INSERT OR REPLACE INTO exposures ("+", ".join(columnNames)+") VALUES ("
+                          +", ".join(":"+name for name in columnNames)+")", rows)
+
+
+def addExposure(param, path, pathCatalog):
+   '''Add or update the exposure param saved at path.
+   '''
+   with connect(pathCatalog) as connection:
+      insertRows(connection, [getRow(param, path)])
+   connection.close()
+
+
+#####################################################
+# Queries
+
+def query(pathCatalog, expType=None, dateCapture=None,
+          hourMin=None, hourMax=None, timeEpochMin=None, timeEpochMax=None,
+          integrationTime=None, hasHotReference=False, perDevice=False, deviceIndex=None):
+   '''Exposures matching all the given criteria, sorted by timeEpoch,
+   as a list of dicts with the catalog columns.
+   hourMin, hourMax [hour] select on hourCapture, bounds included.
+   Multi-dongle exposures saved with multiDeviceSave='separate' appear once,
+   as the combined exposure, unless perDevice is True,
+   in which case only their per-dongle copies are returned,
+   e.g. for the dongle deviceIndex.
+   If hasHotReference is True, only keep the exposures
+   with a hot exposure of the same integrationTime taken before them
+   on the same dateCapture, as used by diy21cm.attemptCalibration.
+   '''
+   conditions = []
+   values = {}
+   for name, operator, value in [('expType', '=', expType),
+                                 ('dateCapture', '=', dateCapture),
+                                 ('hourCapture', '>=', hourMin),
+                                 ('hourCapture', '<=', hourMax),
+                                 ('timeEpoch', '>=', timeEpochMin),
+                                 ('timeEpoch', '<=', timeEpochMax),
+                                 ('integrationTime', '=', integrationTime),
+                                 ('deviceIndex', '=', deviceIndex)]:
+      if value is not None:
+         key = name+str(len(values))
+         conditions.append("e."+name+" "+operator+" :"+key)
+         values[key] = value
+   # older rows without the column are not per-dongle copies
+   conditions.append("COALESCE(e.perDevice, 0) = :perDevice")
+   values['perDevice'] = int(perDevice)
+   if hasHotReference:
+      conditions.append("EXISTS (SELECT 1 FROM exposures h WHERE h.expType = 'hot'"
+                        " AND COALESCE(h.perDevice, 0) = 0"
+                        " AND h.dateCapture = e.dateCapture"
+                        " AND h.integrationTime = e.integrationTime"
+                        " AND h.timeEpoch <= e.timeEpoch)")
+   sql = "SELECT e.* FROM exposures e"
+   if conditions:
+      sql += " WHERE "+" AND ".join(conditions)
+   sql += " ORDER BY e.timeEpoch"
+
+   connection = connect(pathCatalog)
+   rows = [dict(row) for row in connection.execute(sql, values)]
+   connection.close()
+   return rows
+
+
+def getPaths(rows):
+   return [row['path'] for row in rows]
+
+
+#####################################################
+# Rebuild from the output folders
+
+def rebuild(pathRoot, pathCatalog):
+   '''Re-index all the exposure files in the folder pathRoot and its sub-folders.
+   The "latest" copies and the raw IQ sidecar headers are skipped,
+   and when an exposure exists both as npz and json, only the npz is indexed.
+   Only the headers of npz files are read.
+   '''
+   rows = []
+   for dirPath, dirNames, fileNames in os.walk(pathRoot):
+      for fileName in sorted(fileNames):
+         stem, extension = os.path.splitext(fileName)
+         if fileName.startswith('latest') or fileName.endswith('.iq.json'):
+            continue
+         if extension=='.json' and stem+'.npz' in fileNames:
+            continue
+         if extension in ['.npz', '.json']:
+            path = os.path.join(dirPath, fileName)
+            exposure = npz_io.LazyExposure(path)
+            if 'timeCapture' not in exposure:
+               continue
+            rows.append(getRow(exposure.header, path))
+
+   with connect(pathCatalog) as connection:
+      connection.execute("DELETE FROM exposures")
+      insertRows(connection, rows)
+   connection.close()
+   print("Indexed "+str(len(rows))+" exposures from "+pathRoot+" in "+pathCatalog)
+
+
+
+
+#####################################################
+#####################################################
+#####################################################
+
+if __name__=="__main__":
+
+   # Rebuild the catalog of an output tree, e.g.
+   # python catalog.py rebuild ./output
+   if len(sys.argv) > 2 and sys.argv[1]=='rebuild':
+      pathRoot = sys.argv[2]
+      pathCatalog = sys.argv[3] if len(sys.argv) > 3 else os.path.join(pathRoot, 'catalog.sqlite')
+      rebuild(pathRoot, pathCatalog)
+
+   else:
+      # all on-exposures between 3h and 7h with hot references
+      rows = query('./output/catalog.sqlite', expType='on', hourMin=3., hourMax=7., hasHotReference=True)
+      for row in rows:
+         print(row['path'])
@@ -15,17 +15,39 @@ from matplotlib.ticker import FuncFormatter
 import time, logging, os
 from datetime import datetime
 import json_io as json
+import npz_io
+import catalog
+import waterfall
+import calibration
+import pyramid
+import running_stats
+import baseline
+import velocity_frames
 import subprocess # to run shell commands
 
 # To communicate with mount and get ra, dec
-import PyIndi
+# Optional, so that exposures can run without hardware,
+# e.g. from a synthetic or recorded IQ source
+try:
+   import PyIndi
+   IndiBaseClient = PyIndi.BaseClient
+except ImportError:
+   PyIndi = None
+   IndiBaseClient = object
 
 # To communicate with RTL SDR
 # If running outside of the rtlobs github repo,
 # add path
 import sys
 sys.path.append('/home/stellarmate/rtlobs')
-from rtlobs import collect as col, post_process as post, utils as ut
+try:
+   from rtlobs import collect as col, post_process as post, utils as ut
+except ImportError:
+   col = post = ut = None
+# Pipelined acquisition engine
+import acquisition as acq
+import wideband
+import recording
 
 
 #####################################################
@@ -63,13 +85,68 @@ def getDefaultParams():
    param['centerFrequency'] = nu21cm # [GHz] center frequency
    param['integrationTime'] = 30  #5 * 60  # [sec] integration time
 
+   # Acquisition engine parameters
+   param['acquisition'] = 'pipelined' # 'pipelined' reads the IQ source on a separate thread, 'rtlobs' uses col.run_spectrum_int
+   param['nRingBuffer'] = 64 # number of preallocated buffers of nSample samples between USB reads and FFTs
+   param['deviceIndex'] = 0 # index of the RTL SDR dongle
+   param['deviceIndices'] = [0] # indices of the dongles to integrate on simultaneously, one worker process each
+   param['deviceFrequencies'] = None # [Hz] center frequency for each dongle, e.g. [centerFrequency, throwFrequency]. If None, all dongles observe the same frequency
+   param['multiDeviceSave'] = 'combined' # 'combined' to average dongles on the same frequency, 'separate' to also save one file per dongle
+   param['nSettleBuffer'] = 2 # buffers discarded after each (re)tune, while the tuner settles
+
+   # Spectral estimator parameters
+   param['estimator'] = 'welch' # 'welch' as in rtlobs, or 'pfb' polyphase filter bank, with less leakage between bins
+   param['pfbTaps'] = 4 # number of taps per branch of the PFB prototype filter
+   param['pfbWindow'] = 'hann' # window of the windowed-sinc PFB prototype filter
+   param['fftBatch'] = 16 # number of buffers of nSample samples transformed together, in a single batched FFT
+   param['fftBackend'] = 'scipy' # 'scipy', or 'fftw' with cached FFTW plans, if pyfftw is installed
+   param['fftwWisdomFile'] = None # path to a file keeping the FFTW wisdom across runs, for 'fftw'
+   param['fftThreads'] = 1 # number of threads per FFT call
+
+   # RFI excision parameters
+   param['rfiExcision'] = False # drop the block/channel cells flagged by their spectral kurtosis (SK)
+   param['skBuffersPerBlock'] = 32 # number of buffers of nSample samples per SK block
+   param['skSigma'] = 4. # flagging threshold on the SK deviation from 1, in units of its standard deviation
+
+   # IQ source parameters
+   param['iqSource'] = 'rtlsdr' # 'rtlsdr', 'file' to replay a recorded IQ file, or 'synthetic'
+   param['iqFile'] = None # path to the raw uint8 IQ file, for 'file'
+   param['syntheticNoiseLevel'] = 0.2 # rms noise per I/Q component [full scale], for 'synthetic'
+   param['syntheticLineFrequency'] = nu21cm # [Hz] frequency of the synthetic line
+   param['syntheticLineAmplitude'] = 0.1 # peak of the synthetic line, relative to the noise
+   param['syntheticLineWidth'] = 1.e5 # [Hz] rms width of the synthetic line
+   param['syntheticRealTime'] = False # if True, produce synthetic samples at sampleRate, else at full speed
+
+   # Velocity frame of the correction saved with each exposure: 'lsrk', 'barycentric', or None
+   param['velocityFrame'] = 'lsrk'
+
    # Frequency shifting parameters
+   # For the in-band fold of fswitch exposures, the shift must be smaller than the bandwidth
    #throwFrequency = nu21cm + 1.e6 # [Hz] alternate frequency. The freq diff has to be less than achieved bandwidth
    frequencyShift = 2.5e6   # freq offset between fiducial and shifted frequencies [Hz]
    param['throwFrequency'] = nu21cm + frequencyShift # [Hz] alternate frequency. The freq diff has to be less than achieved bandwidth
    # Too bad, I would like a shift of 3.e6 Hz for my 21cm line...
    param['alternatingFrequency'] = 1.   # [Hz] frequency at which we switch between fiducial and shifted freqs
 
+   # Frequency hopping parameters, for wideband exposures
+   param['nHop'] = 3 # number of overlapping center frequencies
+   param['hopOverlap'] = 0.25 # fraction of the bandwidth shared by neighbouring hops
+   param['hopDwellTime'] = 0.5 # [sec] time spent on each hop before retuning
+
+   # Output parameters
+   param['outputFormat'] = 'npz' # 'npz' binary exposure files, or 'json' as before
+   param['shareFrequencyAxes'] = True # for 'npz', save each frequency axis once per output folder, instead of in every exposure
+   param['pyramidMinBin'] = 64 # also save the spectra rebinned by 2, 4, 8... down to this number of channels, for quick looks. None to disable
+   param['statsPath'] = './output/stats' # folder of the running mean and variance of the on spectra, across sessions. None to disable
+   param['statsBinning'] = 'lst' # 'lst' to group the on exposures by local sidereal time bin, or 'pointing' by (ra, dec)
+   param['statsLstBinWidth'] = 0.25 # [hour] width of the LST bins
+   param['baselineKind'] = 'poly' # baseline fitted outside of the line window for the plots: 'poly' (Legendre), 'spline' (cubic B-splines), or None
+   param['baselineOrder'] = 3 # polynomial order, for 'poly'
+   param['baselineNKnot'] = 6 # number of interior knots, for 'spline'
+   param['baselineLineHalfWidth'] = 0.4e6 # [Hz] half width of the window around the 21cm line excluded from the baseline fit
+   param['archiveMode'] = None # for 'npz', None for full precision, or 'float32' or 'uint16' scaled integers, compressed, to save space
+   param['catalogPath'] = './output/catalog.sqlite' # SQLite catalog indexing all the saved exposures. None to disable
+
    return param
 
 def setDate(param):
@@ -78,26 +155,31 @@ def setDate(param):
    param['dateCapture'] = datetime.today().strftime("%Y%m%d")
 
 
-def setTime(param):
-   '''Set current time as hh:mm:ss
+def setTime(param, timeEpoch=None):
+   '''Set current time as hh:mm:ss,
+   and as seconds since the Unix epoch.
+   If timeEpoch [sec] is given, use that time instead of the current time.
    '''
-   param['timeCapture'] = datetime.now().strftime("%Hh%Mm%Ss")
+   now = datetime.now() if timeEpoch is None else datetime.fromtimestamp(timeEpoch)
+   param['timeCapture'] = now.strftime("%Hh%Mm%Ss")
+   param['timeEpoch'] = now.timestamp() # [sec]
 
 
-def setTimeSameDate(param, paramStart):
+def setTimeSameDate(param, paramStart, timeEpoch=None):
    '''Set same date as start date,
    and set current time as hh:mm:ss,
    where hh adds 24 for every day that elapsed
    since the start date.
+   If timeEpoch [sec] is given, use that time instead of the current time.
    '''
    # start by setting the date to the start date
    param['dateCapture'] = paramStart['dateCapture']
    # set the time to the current time
-   setTime(param)
+   setTime(param, timeEpoch)
 
    # Add 24 to the hours for each day elapsed
    # compute number of days elapsed since start
-   nDays = (datetime.today() - datetime.strptime(paramStart['dateCapture'], "%Y%m%d")).days
+   nDays = (datetime.fromtimestamp(param['timeEpoch']) - datetime.strptime(paramStart['dateCapture'], "%Y%m%d")).days
    # Find the position of 'h' in time string
    h_index = param['timeCapture'].index('h')
    m_index = param['timeCapture'].index('m')
@@ -114,7 +196,7 @@ def setTimeSameDate(param, paramStart):
 
 
 def setExpType(param, expType):
-   ''' expType='on', 'foff', 'fswitch', 'hot', 'cold'
+   ''' expType='on', 'foff', 'fswitch', 'wideband', 'raw', 'hot', 'cold'
    '''
    param['expType'] = expType
 
@@ -127,7 +209,7 @@ def setExpType(param, expType):
 
 # The IndiClient class which inherits from the module PyIndi.BaseClient class
 # Note that all INDI constants are accessible from the module as PyIndi.CONSTANTNAME
-class IndiClient(PyIndi.BaseClient):
+class IndiClient(IndiBaseClient):
     def __init__(self):
         super(IndiClient, self).__init__()
         self.logger = logging.getLogger('IndiClient')
@@ -231,72 +313,110 @@ def listINDIDevices():
    indiClient.disconnectServer()
 
 
-def setMountInfo(param):
-   '''Get mount info from INDI server:
-   ra, dec, lat, lon.
+def setNoMountInfo(param):
+   '''Unknown mount info ra, dec, lat, lon, without querying the INDI server,
+   e.g. before they are read at the start of a session slice.
    '''
-   # Parameters to be read from INDI server
    param['ra'] = np.nan
    param['dec'] = np.nan
    param['lat'] = np.nan
    param['lon'] = np.nan
+
+
+def setMountInfo(param, velocityCorrection=True):
+   '''Get mount info from INDI server:
+   ra, dec, lat, lon,
+   then the velocity correction, unless velocityCorrection is False.
+   '''
+   # Parameters to be read from INDI server
+   setNoMountInfo(param)
    # Print all INDI messages
    #logging.basicConfig(format = '%(asctime)s %(message)s', level = logging.INFO)
 
+   # No mount without the hardware, e.g. with a synthetic or recorded IQ source
+   if param['iqSource']!='rtlsdr':
+      print("No mount with the "+param['iqSource']+" IQ source")
+   elif PyIndi is None:
+      print("PyIndi is not installed, could not read ra, dec from mount")
    # Try reading ra, dec from mount
-   try:
-      # Create an instance of the IndiClient class and initialize its host/port members
-      indiClient=IndiClient()
-      indiClient.setServer("localhost", 7624)
-
-      # Connect to server
-      print("Connecting and waiting 1 sec")
-      if not indiClient.connectServer():
-           print(f"No indiserver running on {indiClient.getHost()}:{indiClient.getPort()} - Try to run")
-           print("  indiserver indi_simulator_telescope indi_simulator_ccd")
-           sys.exit(1)
-
-      # Waiting to discover devices
-      time.sleep(1)
-
-      # Select the device corresponding to the telescope mount
-      deviceList = indiClient.getDevices()
-      for device in deviceList:
-         if device.getDeviceName()==param['mountDeviceName']:		
-            # Get list of properties for this device
-            genericPropertyList = device.getProperties()
-            for genericProperty in genericPropertyList:			
-
-               # Select the equatorial coordinates property
-               if genericProperty.getName()==param['raDecPropertyName']:
-                  for widget in PyIndi.PropertyNumber(genericProperty):
-                     # read ra
-                     if widget.getName()=="RA":
-                        param['ra'] = widget.getValue()
-                     # read dec
-                     elif widget.getName()=="DEC":
-                        param['dec'] = widget.getValue()
-
-
-               # Select the geographic coordinates property
-               if genericProperty.getName()==param['latLonPropertyName']:
-                  for widget in PyIndi.PropertyNumber(genericProperty):
-                     # read latitude
-                     if widget.getName()=="LAT":
-                        param['lat'] = widget.getValue() # [deg]
-                     # read longitude
-                     elif widget.getName()=="LONG":
-                        param['lon'] = widget.getValue() # [deg]
-
-   except:
-      print("Could not read ra, dec from mount")
+   else:
+      try:
+         # Create an instance of the IndiClient class and initialize its host/port members
+         indiClient=IndiClient()
+         indiClient.setServer("localhost", 7624)
+
+         # Connect to server
+         print("Connecting and waiting 1 sec")
+         if not indiClient.connectServer():
+              print(f"No indiserver running on {indiClient.getHost()}:{indiClient.getPort()} - Try to run")
+              print("  indiserver indi_simulator_telescope indi_simulator_ccd")
+              sys.exit(1)
+
+         # Waiting to discover devices
+         time.sleep(1)
+
+         # Select the device corresponding to the telescope mount
+         deviceList = indiClient.getDevices()
+         for device in deviceList:
+            if device.getDeviceName()==param['mountDeviceName']:		
+               # Get list of properties for this device
+               genericPropertyList = device.getProperties()
+               for genericProperty in genericPropertyList:			
+
+                  # Select the equatorial coordinates property
+                  if genericProperty.getName()==param['raDecPropertyName']:
+                     for widget in PyIndi.PropertyNumber(genericProperty):
+                        # read ra
+                        if widget.getName()=="RA":
+                           param['ra'] = widget.getValue()
+                        # read dec
+                        elif widget.getName()=="DEC":
+                           param['dec'] = widget.getValue()
+
+
+                  # Select the geographic coordinates property
+                  if genericProperty.getName()==param['latLonPropertyName']:
+                     for widget in PyIndi.PropertyNumber(genericProperty):
+                        # read latitude
+                        if widget.getName()=="LAT":
+                           param['lat'] = widget.getValue() # [deg]
+                        # read longitude
+                        elif widget.getName()=="LONG":
+                           param['lon'] = widget.getValue() # [deg]
+
+      except:
+         print("Could not read ra, dec from mount")
 
    print("Mount info from INDI server:")
-   print("RA = "+str(param['ra'])+" deg")
+   print("RA = "+str(param['ra'])+" hours")
    print("Dec="+str(param['dec'])+" deg")
    print("Lat="+str(param['lat'])+" deg")
    print("Lon="+str(param['lon'])+" deg")
 
+   # Doppler correction for this pointing, site and time
+   if velocityCorrection:
+      setVelocityCorrection(param)
+
+
+def setVelocityCorrection(param):
+   '''Velocity correction [m/s] from topocentric to param['velocityFrame'],
+   for the pointing, site and time of capture,
+   to add to the radial velocities of the exposure.
+   The frequencies in that frame are
+   velocity_frames.shiftFrequencies(param['fOn'], param['vCorrection']).
+   If it cannot be computed, e.g. without astropy, vCorrection is nan.
+   '''
+   if param['velocityFrame'] is None:
+      return
+   try:
+      param['vCorrection'] = float(velocity_frames.getVelocityCorrection(param['ra'], param['dec'],
+                                   param['lat'], param['lon'], catalog.getTimeEpoch(param),
+                                   frame=param['velocityFrame']))
+   except Exception as e:
+      print("Could not compute the velocity correction: "+str(e))
+      param['vCorrection'] = np.nan
+   print("Velocity correction to "+param['velocityFrame']+" = "+str(param['vCorrection'] * 1.e-3)+" km/s")
+
 
 #####################################################
 # Set output and figure file names, complete header
@@ -347,132 +467,346 @@ def getLatestName(param, expType=None):
 #################################################################
 # RTL SDR
 
-def biasTOn():
-   '''Turn on the bias T,
+def hasBiasT(param=None):
+   '''False if the bias T cannot or need not be switched:
+   rtlobs is not installed, or param uses a synthetic or recorded IQ source.
+   '''
+   if param is not None and param['iqSource']!='rtlsdr':
+      print("No bias T with the "+param['iqSource']+" IQ source")
+      return False
+   if ut is None:
+      print("rtlobs is not installed, could not switch the bias T")
+      return False
+   return True
+
+
+def biasTOn(index=0, param=None):
+   '''Turn on the bias T of dongle index,
    to power the LNA.
+   Skipped if param is given and its IQ source is not the RTL-SDR.
    '''
+   if not hasBiasT(param):
+      return
    try:
-      ut.biast(1, index=0) # turn on bias tee, to power LNA
+      ut.biast(1, index=index) # turn on bias tee, to power LNA
    except:
       print('Failed to turn on bias T')
 
 
-def biasTOff():
-   '''Turn off the bias T,
+def biasTOff(index=0, param=None):
+   '''Turn off the bias T of dongle index,
    to power off the LNA.
+   Skipped if param is given and its IQ source is not the RTL-SDR.
    '''
+   if not hasBiasT(param):
+      return
    try:
-      ut.biast(0, index=0) # turn on bias tee, to power LNA
+      ut.biast(0, index=index) # turn off bias tee, to power off LNA
    except:
       print('Failed to turn off bias T')
 
 
-def takeExposure(param):
+def biasTOnDevices(param):
+   '''Turn on the bias T of all the dongles in param['deviceIndices'],
+   to power their LNAs.
+   '''
+   for deviceIndex in param['deviceIndices']:
+      biasTOn(deviceIndex, param=param)
+
+
+def biasTOffDevices(param):
+   '''Turn off the bias T of all the dongles in param['deviceIndices'].
+   '''
+   for deviceIndex in param['deviceIndices']:
+      biasTOff(deviceIndex, param=param)
+
+
+def integrateSpectrum(param, centerFrequency, session=None):
+   '''Integrate a power spectrum at centerFrequency [Hz],
+   either from the continuous session if provided,
+   or with the pipelined engine, or with rtlobs.
+   Returns f [Hz], p [V^2/Hz].
+   '''
+   if session is not None:
+      return session.nextSpectrum(param)
+   elif param['acquisition']=='pipelined':
+      return acq.runSpectrumPipelined(param, centerFrequency)
+   else:
+      return col.run_spectrum_int(param['nSample'], 
+                                  param['nBin'], 
+                                  param['gain'], 
+                                  param['sampleRate'], 
+                                  centerFrequency, 
+                                  param['integrationTime'])
+
+
+def getPointing(param):
+   '''Mount info ra, dec, lat, lon, read now from the INDI server.
+   '''
+   paramMount = dict(param)
+   setMountInfo(paramMount, velocityCorrection=False)
+   return {key: paramMount[key] for key in ['ra', 'dec', 'lat', 'lon']}
+
+
+def openSession(param):
+   '''Open the IQ source and keep it streaming across exposures,
+   at param['centerFrequency'] and for slices of param['integrationTime'].
+   The mount info is read at the start of each slice.
+   Pass the session to takeExposure for 'on', 'hot' or 'cold' exposures,
+   and close it when done.
+   '''
+   return acq.AcquisitionSession(param, onSliceStart=lambda: getPointing(param))
+
+
+def setSliceInfo(param):
+   '''Label an exposure from a session with the start time of its slice,
+   keeping the date of param['dateCapture'] as in setTimeSameDate,
+   and with the mount info read at that time.
+   Updates the velocity correction and the file name accordingly.
+   '''
+   setTimeSameDate(param, param, timeEpoch=param['timeStartEpoch'])
+   setVelocityCorrection(param)
+   setFileName(param)
+
+
+def takeExposureMultiDevice(param):
+   '''Integrate simultaneously on all dongles in param['deviceIndices'].
+   Dongles tuned to the center frequency are averaged into pOn,
+   dongles tuned to the throw frequency are averaged into pOff.
+   The individual spectra and per-dongle statistics are kept as well,
+   e.g. pDevices and the RFI masks rfiMaskPackedDevices (nDevice, nBlock, nBin/8).
+   '''
+   nDevice = len(param['deviceIndices'])
+   if param['deviceFrequencies'] is None:
+      if param['expType']=='foff':
+         frequencies = [param['throwFrequency']] * nDevice
+      else:
+         frequencies = [param['centerFrequency']] * nDevice
+   else:
+      frequencies = list(param['deviceFrequencies'])
+
+   # check the mapping of dongles to frequencies before integrating
+   if len(frequencies)!=nDevice:
+      raise ValueError("deviceFrequencies has "+str(len(frequencies))+" frequencies for "+str(nDevice)+" dongles in deviceIndices")
+   for frequency in frequencies:
+      if frequency not in [param['centerFrequency'], param['throwFrequency']]:
+         raise ValueError("Dongle frequency "+str(frequency)+" Hz is neither the center nor the throw frequency")
+   requiredFrequency = param['throwFrequency'] if param['expType']=='foff' else param['centerFrequency']
+   if requiredFrequency not in frequencies:
+      raise ValueError("No dongle in deviceFrequencies is tuned to "+str(requiredFrequency)+" Hz, needed for a "+param['expType']+" exposure")
+
+   # power the LNAs of all the dongles
+   biasTOnDevices(param)
+
+   results = acq.runMultiDevice(param, param['deviceIndices'], frequencies)
+
+   # per-dongle spectra and metadata
+   param['deviceCenterFrequencies'] = np.array(frequencies)
+   param['fDevices'] = np.array([result[0] for result in results])
+   param['pDevices'] = np.array([result[1] for result in results])
+   for key in acq.deviceStatsKeys:
+      param[key+'Devices'] = np.array([result[2][key] for result in results])
+   param['dutyCycle'] = np.mean(param['dutyCycleDevices'])
+   param['nDroppedBuffers'] = int(np.sum(param['nDroppedBuffersDevices']))
+
+   # combine the dongles observing the same frequency
+   iOn = [i for i in range(nDevice) if frequencies[i]==param['centerFrequency']]
+   iOff = [i for i in range(nDevice) if frequencies[i]==param['throwFrequency']]
+   if len(iOn) > 0:
+      param['fOn'] = param['fDevices'][iOn[0]]
+      param['pOn'] = np.mean(param['pDevices'][iOn], axis=0)
+   if len(iOff) > 0:
+      param['fOff'] = param['fDevices'][iOff[0]]
+      param['pOff'] = np.mean(param['pDevices'][iOff], axis=0)
+
+
+def isSessionExposure(param):
+   '''True if the exposure can be taken from an AcquisitionSession:
+   single-dongle 'on', 'hot' or 'cold' exposures.
+   '''
+   return param['expType'] in ['on', 'hot', 'cold'] and len(param['deviceIndices'])==1
+
+
+def takeExposure(param, session=None):
+
+   # the other exposures need the dongle:
+   # pause the session meanwhile, and read the pointing now
+   if session is not None and not isSessionExposure(param):
+      session.pause()
+      try:
+         setMountInfo(param)
+         setFileName(param)
+         takeExposure(param)
+      finally:
+         session.resume()
+      return
 
    try:
       # get f [Hz], p [V^2/Hz]
       tStart = time.time()
       #
-      if param['expType']=='on' or param['expType']=='hot' or param['expType']=='cold':
-         f, p = col.run_spectrum_int(param['nSample'], 
-                                     param['nBin'], 
-                                     param['gain'], 
-                                     param['sampleRate'], 
-                                     param['centerFrequency'], 
-                                     param['integrationTime'])
+      if len(param['deviceIndices']) > 1 and param['expType'] in ['on', 'hot', 'cold', 'foff']:
+         takeExposureMultiDevice(param)
+         param['expStatus'] = True
+      #
+      elif param['expType']=='on' or param['expType']=='hot' or param['expType']=='cold':
+         f, p = integrateSpectrum(param, param['centerFrequency'], session=session)
+         # the slice may have started before this call
+         if session is not None:
+            setSliceInfo(param)
          param['fOn'] = f
          param['pOn'] = p
          param['expStatus'] = True
       #
       elif param['expType']=='foff':
-         f, p = col.run_spectrum_int(param['nSample'], 
-                                     param['nBin'], 
-                                     param['gain'], 
-                                     param['sampleRate'], 
-                                     param['throwFrequency'], 
-                                     param['integrationTime'])
+         f, p = integrateSpectrum(param, param['throwFrequency'])
          param['fOff'] = f
          param['pOff'] = p
          param['expStatus'] = True
       #
       elif param['expType']=='fswitch':
-         fOn, pOn, fOff, pOff = col.run_fswitch_int(param['nSample'], 
-                                    param['nBin'], 
-                                    param['gain'], 
-                                    param['sampleRate'], 
-                                    param['centerFrequency'], 
-                                    param['throwFrequency'], 
-                                    param['integrationTime'], 
-                                    fswitch=param['alternatingFrequency'])
+         if param['acquisition']=='pipelined':
+            fOn, pOn, fOff, pOff = acq.runFswitchPipelined(param)
+         else:
+            fOn, pOn, fOff, pOff = col.run_fswitch_int(param['nSample'], 
+                                       param['nBin'], 
+                                       param['gain'], 
+                                       param['sampleRate'], 
+                                       param['centerFrequency'], 
+                                       param['throwFrequency'], 
+                                       param['integrationTime'], 
+                                       fswitch=param['alternatingFrequency'])
          param['fOn'] = fOn
          param['pOn'] = pOn
          param['fOff'] = fOff
          param['pOff'] = pOff
          param['expStatus'] = True
       #
+      elif param['expType']=='raw':
+         # record the raw IQ stream, while integrating the spectrum as usual
+         path = recording.getRawPath(param)
+         with open(path, 'wb') as rawFile:
+            f, p = acq.runSpectrumPipelined(param, param['centerFrequency'], rawFile=rawFile)
+         recording.saveHeader(param, path)
+         # where the dropped buffers left gaps in the recording
+         recording.saveBufferIndices(param.pop('rawBufferIndices'), path)
+         param['iqPath'] = path
+         param['fOn'] = f
+         param['pOn'] = p
+         param['expStatus'] = True
+      #
+      elif param['expType']=='wideband':
+         hopFrequencies, fHops, pHops = acq.runWidebandPipelined(param)
+         f, p, gains = wideband.stitchSpectra(fHops, pHops, wideband.getNOverlap(param))
+         param['hopFrequencies'] = hopFrequencies
+         param['fHops'] = fHops
+         param['pHops'] = pHops
+         param['hopGains'] = gains
+         param['fOn'] = f
+         param['pOn'] = p
+         param['expStatus'] = True
+      #
       else:
          param['expStatus'] = False
       #
+      # fold the frequency-switched halves, if both are present
+      if param['expStatus'] and 'pOn' in param and 'pOff' in param:
+         attemptFold(param)
+      #
       tStop = time.time()
       print("Single exposure of "+str(param['integrationTime'])+" sec took "+str(round(tStop-tStart))+" sec")
       print("Time overhead is "+str(round( ((tStop-tStart)/param['integrationTime'] -1)*100. ))+"%")
 
-   except:
-      print('Exposure failed')
+   except Exception as e:
+      print('Exposure failed: '+str(e))
       param['expStatus'] = False
 
 
 
-def calibrateHotCold(p, pH, pC, tH, tC):
-   '''compute calibrated temperature spectum t [K]
-   from power spectra p, pH, pC [any unit]
-   measured at temperatures t, tH, tC [K].
-   Assumes
-   p = factor * (t + tOffset)
+def foldFrequencySwitched(fOn, pOn, fOff, pOff):
+   '''In-band fold of a frequency-switched exposure.
+   The difference (pOn - pOff) / pOff shows the line twice:
+   positive at its frequency in the on band,
+   and negative, shifted by the throw, from the off band.
+   Shifting by the throw and averaging both copies
+   improves the SNR by sqrt(2).
+   pOn, pOff may be single spectra, or stacks of spectra (..., nBin).
+   Returns fFold [Hz] and pFold [dimless] on the channels where both copies exist,
+   or None, None if the throw is larger than the bandwidth.
    '''
-   # Solve for affine parameters
-   factor = (pH - pC) / (tH - tC)  # [dimless]
-   tOffset = (tH * pC - tC * pH) / (pH - pC) # [K]
-   # invert the power to temperature relation
-   t = p / factor - tOffset   # [K]
-   return t
+   nBin = len(fOn)
+   # throw in number of channels
+   shift = int(round((fOff[0] - fOn[0]) / (fOn[1] - fOn[0])))
+   if abs(shift) >= nBin:
+      return None, None
+
+   diff = (pOn - pOff) / pOff
+   if shift >= 0:
+      fFold = fOn[shift:]
+      pFold = 0.5 * (diff[..., shift:] - diff[..., :nBin - shift])
+   else:
+      fFold = fOn[:nBin + shift]
+      pFold = 0.5 * (diff[..., :nBin + shift] - diff[..., -shift:])
+   return fFold, pFold
 
 
-def calibratePartial(p, pRef, tRef):
-   '''compute partially-calibrated temperature spectrum t [K]
-   from power spectrum p [au],
-   based on a reference power spectrum pRef [au]
-   measured at temperature tRef [K].
-   Assumes
-   p = factor * t
+def attemptFold(param):
+   '''Fold the on and off halves of a frequency-switched exposure,
+   if the throw is small enough for both bands to overlap.
    '''
-   t = tRef * p / pRef  # [K]
-   return t
+   fFold, pFold = foldFrequencySwitched(param['fOn'], param['pOn'], param['fOff'], param['pOff'])
+   if fFold is None:
+      print("No in-band fold: the throw frequency is outside the band")
+   else:
+      param['fFold'] = fFold
+      param['pFold'] = pFold
+
+
+# calibration formulas, vectorized, shared with the batch calibration
+calibrateHotCold = calibration.calibrateHotCold
+calibratePartial = calibration.calibratePartial
+
+
+def checkReference(param, pRef, expType):
+   '''Calibration reference pRef, or None if it is missing
+   or does not have the channels of param['pOn'], e.g. for a wideband exposure.
+   '''
+   if pRef is not None and np.shape(pRef)!=np.shape(param['pOn']):
+      print("Ignoring the "+expType+" reference: "+str(np.shape(pRef)[-1])+" channels, vs "
+            +str(np.shape(param['pOn'])[-1])+" in this exposure")
+      return None
+   return pRef
 
 
 def attemptCalibration(param):
    '''Check if a latest hot and/or cold exposure
    exists in the output folder.
-   If so, use them/it for complete/partial calibration.
+   If so, use them/it for complete/partial calibration,
+   provided they have the same channels as the exposure, see checkReference.
    '''
+   # nothing to calibrate, e.g. if the exposure failed
+   if 'pOn' not in param:
+      return
+
    # flag to indicate if calibrations are possible
    partialCalib = False
    fullCalib = True
 
-   # check if cold exposure exists
-   pathCold = param['pathOut']+'/'+getLatestName(param, expType='cold')+'.json'
-   if os.path.exists(pathCold):
-      paramCold = json.loadJson(pathCold)
-      param['pCold'] = paramCold['pOn']
+   # check if cold exposure exists,
+   # from the in-memory cache of the calibration references
+   pCold = calibration.referenceCache.get(param['pathOut']+'/'+getLatestName(param, expType='cold'))
+   pCold = checkReference(param, pCold, 'cold')
+   if pCold is not None:
+      param['pCold'] = pCold
       partialCalib = True
    else:
       fullCalib = False
 
    # check if hot exposure exists
-   pathHot = param['pathOut']+'/'+getLatestName(param, expType='hot')+'.json'
-   if os.path.exists(pathHot):
-      paramHot = json.loadJson(pathHot)
-      param['pHot'] = paramHot['pOn']
+   pHot = calibration.referenceCache.get(param['pathOut']+'/'+getLatestName(param, expType='hot'))
+   pHot = checkReference(param, pHot, 'hot')
+   if pHot is not None:
+      param['pHot'] = pHot
       partialCalib = True
    else:
       fullCalib = False
@@ -482,34 +816,151 @@ def attemptCalibration(param):
       param['tCalibratedHotCold'] = calibrateHotCold(param['pOn'], 
             param['pHot'], 
             param['pCold'], 
-            300., # tHot [K] 
-            20.)  # tCold [K]
+            calibration.tHot, # [K]
+            calibration.tCold)  # [K]
    # else perform partial calibration if possible
    elif partialCalib:
       if 'pCold' in param:
          pRef = param['pCold']
          param['tCalibratedCold'] = calibratePartial(param['pOn'], 
                pRef, 
-               20.)  # tCold [K]
+               calibration.tCold)  # [K]
       elif 'pHot' in param:
          pRef = param['pHot']
          param['tCalibratedHot'] = calibratePartial(param['pOn'], 
                pRef, 
-               300.)  # tCold [K]
+               calibration.tHot)  # [K]
 
 
 
+def splitDevices(param):
+   '''Split a multi-dongle exposure into one param dict per dongle,
+   with its own pOn or pOff, deviceIndex, statistics, RFI masks and file name.
+   '''
+   paramDevices = []
+   for i, deviceIndex in enumerate(param['deviceIndices']):
+      paramDevice = {key: value for key, value in param.items() 
+                     if not key.endswith('Devices') and not key.startswith('tCalibrated')}
+      paramDevice['deviceIndex'] = deviceIndex
+      # so that the catalog does not count the exposure twice
+      paramDevice['perDevice'] = True
+      paramDevice['centerFrequency'] = param['deviceCenterFrequencies'][i]
+      if param['deviceCenterFrequencies'][i]==param['throwFrequency']:
+         paramDevice['fOff'] = param['fDevices'][i]
+         paramDevice['pOff'] = param['pDevices'][i]
+         paramDevice.pop('fOn', None)
+         paramDevice.pop('pOn', None)
+      else:
+         paramDevice['fOn'] = param['fDevices'][i]
+         paramDevice['pOn'] = param['pDevices'][i]
+         paramDevice.pop('fOff', None)
+         paramDevice.pop('pOff', None)
+      for key in acq.deviceStatsKeys:
+         value = param[key+'Devices'][i]
+         # scalars as python numbers, for the json header
+         paramDevice[key] = value.item() if np.ndim(value)==0 else value
+      paramDevice['fileName'] = param['fileName']+"_dev"+str(deviceIndex)
+      paramDevices.append(paramDevice)
+   return paramDevices
+
+
+def loadExposure(path):
+   '''Load an exposure file, in the npz or json format.
+   '''
+   if path.endswith('.npz'):
+      return npz_io.loadNpz(path)
+   else:
+      return json.loadJson(path)
+
+
+def openExposure(path):
+   '''Lazy handle on an exposure file, in the npz or json format:
+   the scalar parameters are read right away, e.g. exposure['timeCapture'],
+   and each array only when accessed, e.g. exposure['pOn'].
+   '''
+   return npz_io.LazyExposure(path)
+
+
+def saveExposure(param, pathStem):
+   '''Save an exposure file, in the format param['outputFormat'].
+   The file is written under a temporary name, then renamed,
+   so that readers of the "latest" files never see a partial file.
+   Returns the path of the file.
+   '''
+   # add the rebinned levels of the spectra
+   if param['pyramidMinBin'] is not None:
+      param = dict(param)
+      pyramid.addPyramid(param, param['pyramidMinBin'])
+
+   if param['outputFormat']=='npz':
+      path = pathStem+".npz"
+      pathTmp = path+"."+str(os.getpid())+".tmp"
+      npz_io.saveNpz(param, pathTmp, shareAxes=param['shareFrequencyAxes'], archive=param['archiveMode'])
+   else:
+      path = pathStem+".json"
+      pathTmp = path+"."+str(os.getpid())+".tmp"
+      json.saveJson(param, pathTmp)
+   os.replace(pathTmp, path)
+   return path
+
+
 def saveJson(param):
    # save all parameters and data
-   path = param['pathOut']+"/"+param['fileName']+".json"
-   json.saveJson(param, path)
+   path = saveExposure(param, param['pathOut']+"/"+param['fileName'])
+   if param['catalogPath'] is not None:
+      catalog.addExposure(param, path, param['catalogPath'])
 
    # also save to/overwrite the "latest"
-   path = param['pathOut']+"/"+getLatestName(param)+".json"
-   json.saveJson(param, path)
+   pathStem = param['pathOut']+"/"+getLatestName(param)
+   path = saveExposure(param, pathStem)
+   # new calibration references go straight to the cache
+   if param['expType'] in ['hot', 'cold'] and 'pOn' in param:
+      calibration.referenceCache.put(pathStem, path, param['pOn'])
+
+   # also save each dongle separately, if requested
+   if param['multiDeviceSave']=='separate' and 'pDevices' in param:
+      for paramDevice in splitDevices(param):
+         path = saveExposure(paramDevice, paramDevice['pathOut']+"/"+paramDevice['fileName'])
+         if param['catalogPath'] is not None:
+            catalog.addExposure(paramDevice, path, param['catalogPath'])
+
+
+def getWaterfallStem(param):
+   '''Stem of the session waterfall files for this exposure type.
+   '''
+   return param['pathOut']+"/"+param['dateCapture']+"_waterfall_"+param['expType']
 
 
-def plot(f, p, label=None, yLabel=r'Uncalibrated intensity [au]'):
+def appendWaterfall(param):
+   '''Append pOn to the waterfall of the observing session,
+   with its time and pointing.
+   Exposures without pOn are skipped.
+   '''
+   if 'pOn' not in param:
+      return
+   record = {name: param.get(name) for name in waterfall.tableFields}
+   record['hourCapture'] = catalog.getHourCapture(param['timeCapture'])
+   # a new waterfall if the frequencies changed during the session
+   pathStem = waterfall.getStem(getWaterfallStem(param), param['fOn'])
+   waterfall.Waterfall(pathStem).append(param['fOn'], param['pOn'], record)
+
+
+def plot(f, p, label=None, yLabel=r'Uncalibrated intensity [au]', nPixel=None):
+    '''Plot the spectrum p at frequencies f [Hz],
+    or the list or 2D array of spectra.
+    If nPixel is given, the spectra are rebinned by 2, 4, 8...
+    to the coarsest level with at least nPixel channels.
+    For exposures saved with a pyramid, use pyramid.getSpectrum
+    to read only that level.
+    '''
+    if nPixel is not None:
+        if isinstance(f, list):
+            rebinned = [pyramid.rebinToWidth(f_arr, p_arr, nPixel) for f_arr, p_arr in zip(f, p)]
+            f = [x[0] for x in rebinned]
+            p = [x[1] for x in rebinned]
+        else:
+            f, p = pyramid.rebinToWidth(f, np.asarray(p), nPixel)
+
     fig=plt.figure(0)
     ax=fig.add_subplot(111)
     #
@@ -567,7 +1018,7 @@ def plot(f, p, label=None, yLabel=r'Uncalibrated intensity [au]'):
 def savePlot(param):
    # Generate plots only if the exposure was successfully acquired
    if param['expStatus']:
-      if param['expType']=='on' or param['expType']=='hot' or param['expType']=='cold':
+      if param['expType'] in ['on', 'hot', 'cold', 'wideband', 'raw']:
          fig, ax, ax2 = plot(param['fOn'], param['pOn'], label=param['expType'], yLabel=r'P [V$^2$/Hz]')
       elif param['expType']=='foff':
          fig, ax, ax2 = plot(param['fOff'], param['pOff'], label=r'fOff', yLabel=r'P [V$^2$/Hz]')
@@ -602,6 +1053,35 @@ def savePlot(param):
          #
          fig.clf()
 
+      # If requested, plot the on spectrum over its fitted baseline
+      if param['baselineKind'] is not None and param['expType']=='on':
+         pOverBaseline, rms = baseline.removeBaseline(param['fOn'], param['pOn'],
+               kind=param['baselineKind'],
+               order=param['baselineOrder'],
+               nKnot=param['baselineNKnot'],
+               lineHalfWidth=param['baselineLineHalfWidth'])
+         print("Baseline fit residual rms = "+str(rms)+" (fraction of the baseline: "+str(rms / np.mean(param['pOn']))+")")
+         fig, ax, ax2 = plot(param['fOn'], pOverBaseline, label=r'on', yLabel=r'P / baseline - 1')
+
+         # save to unique file name
+         fig.savefig(param['pathFig']+"/"+param['fileName']+"_baseline.pdf", bbox_inches='tight')
+         # also save to/overwrite the "latest"
+         fig.savefig(param['pathFig']+"/"+getLatestName(param)+"_baseline.pdf", bbox_inches='tight')
+         #
+         fig.clf()
+
+      # If the frequency-switched exposure was folded,
+      # plot the folded spectrum
+      if 'pFold' in param:
+         fig, ax, ax2 = plot(param['fFold'], param['pFold'], label=r'folded', yLabel=r'(P$_\text{on}$ - P$_\text{off}$) / P$_\text{off}$')
+
+         # save to unique file name
+         fig.savefig(param['pathFig']+"/"+param['fileName']+"_fold.pdf", bbox_inches='tight')
+         # also save to/overwrite the "latest"
+         fig.savefig(param['pathFig']+"/"+getLatestName(param)+"_fold.pdf", bbox_inches='tight')
+         #
+         fig.clf()
+
 def saveScreenshot(param):
    '''Save a screenshot to the figures folder.
    Useful in transiting mode, to generate a timelapse.
@@ -619,6 +1099,44 @@ def saveScreenshot(param):
 
 
 
+def updateRunningStats(param):
+   '''Add pOn of an on exposure to the running mean and variance
+   of its sky bin, in param['statsPath'].
+   '''
+   if param['statsPath'] is None or param['expType']!='on' or 'pOn' not in param:
+      return
+   binName = running_stats.getBinName(dict(param, timeEpoch=catalog.getTimeEpoch(param)),
+                                      binning=param['statsBinning'],
+                                      lstBinWidth=param['statsLstBinWidth'])
+   # one folder per frequency axis
+   pathStats = running_stats.getStatsPath(param['statsPath'], param['fOn'], binning=param['statsBinning'])
+   stats = running_stats.update(pathStats, binName, param['fOn'], param['pOn'])
+   print("Running stats "+binName+": "+str(stats.count)+" exposures")
+
+
+def saveOutputs(param):
+   '''Save the exposure, append it to the session waterfall,
+   and update the running statistics.
+   Only file I/O, without pyplot, so that it can run on an output_writer.OutputWriter,
+   while the next exposure is acquired.
+   '''
+   saveJson(param)
+   appendWaterfall(param)
+   updateRunningStats(param)
+
+
+def saveFigures(param, screenshotDelay=5):
+   '''Save the plots of the exposure, then a screenshot for the timelapse.
+   Must run on the main thread: pyplot is not thread-safe with the GUI backends.
+   '''
+   savePlot(param)
+
+   # take a screenshot for the timelapse
+   # after some time, so the open figures
+   # have time to update
+   time.sleep(screenshotDelay) # delay in [sec]
+   saveScreenshot(param)
+
 
 #####################################################
 #####################################################
@@ -642,6 +1160,8 @@ if __name__=="__main__":
    setExpType(param, 'on')
    #setExpType(param, 'foff')
    #setExpType(param, 'fswitch')
+   #setExpType(param, 'wideband')
+   #setExpType(param, 'raw')
    #d21.setExpType(param, 'cold')
    #d21.setExpType(param, 'hot')
 
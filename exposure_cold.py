@@ -13,6 +13,8 @@ param['integrationTime'] = 5*60  # [sec]
 #d21.setExpType(param, 'on')
 #d21.setExpType(param, 'foff')
 #d21.setExpType(param, 'fswitch')
+#d21.setExpType(param, 'wideband')
+#d21.setExpType(param, 'raw')
 d21.setExpType(param, 'cold')
 #d21.setExpType(param, 'hot')
 
@@ -0,0 +1,84 @@
+# Cached FFT plans, window tables and frequency axes for the spectral core.
+# The spectra are computed in single precision (complex64) throughout,
+# by batches of many frames in a single 2-D FFT call.
+# With pyfftw installed, and fftBackend='fftw', the FFTW plans are built
+# once per batch shape and reused, and the FFTW wisdom can be kept
+# in a file, so that the planning cost is paid only once per machine.
+
+import numpy as np
+import scipy.fft
+from scipy import signal
+from functools import lru_cache
+import os, pickle
+
+# Optional FFTW backend
+try:
+   import pyfftw
+except ImportError:
+   pyfftw = None
+
+
+@lru_cache(maxsize=None)
+def getWindow(window, nBin):
+   '''Periodic window of nBin points, as in scipy.signal.welch, in float32.
+   '''
+   w = signal.get_window(window, nBin).astype(np.float32)
+   w.flags.writeable = False
+   return w
+
+
+@lru_cache(maxsize=None)
+def getFrequencyAxis(nBin, sampleRate, centerFrequency=0.):
+   '''Frequencies [Hz] of the shifted spectrum, from the lowest to the highest,
+   for nBin bins, at sampleRate [Hz] and centerFrequency [Hz].
+   '''
+   f = np.fft.fftshift(np.fft.fftfreq(nBin, d=1. / sampleRate)) + centerFrequency
+   f.flags.writeable = False
+   return f
+
+
+#####################################################
+# FFT backends
+
+class FFT:
+   '''FFT along the last axis, complex64 in and out.
+   backend is 'scipy' (pocketfft, which caches its own twiddle factors),
+   or 'fftw', with one cached FFTW plan per input shape.
+   If wisdomFile is given, the FFTW wisdom is loaded from it,
+   and saved back whenever a new plan is built.
+   '''
+   def __init__(self, backend='scipy', wisdomFile=None, threads=1):
+      if backend=='fftw' and pyfftw is None:
+         print("pyfftw is not installed, using the scipy FFT")
+         backend = 'scipy'
+      self.backend = backend
+      self.wisdomFile = wisdomFile
+      self.threads = threads
+      self.plans = {}
+      if self.backend=='fftw' and wisdomFile is not None and os.path.exists(wisdomFile):
+         with open(wisdomFile, 'rb') as f:
+            pyfftw.import_wisdom(pickle.load(f))
+
+   def getPlan(self, shape):
+      '''FFTW plan for complex64 inputs of this shape, built once.
+      '''
+      if shape not in self.plans:
+         a = pyfftw.empty_aligned(shape, dtype='complex64')
+         self.plans[shape] = pyfftw.builders.fft(a, axis=-1, threads=self.threads,
+                                                 planner_effort='FFTW_MEASURE', avoid_copy=False)
+         if self.wisdomFile is not None:
+            with open(self.wisdomFile, 'wb') as f:
+               pickle.dump(pyfftw.export_wisdom(), f)
+      return self.plans[shape]
+
+   def __call__(self, x):
+      if self.backend=='fftw':
+         return self.getPlan(x.shape)(x)
+      else:
+         return scipy.fft.fft(x, axis=-1, workers=self.threads)
+
+
+# one FFT object per configuration, shared by all estimators
+@lru_cache(maxsize=None)
+def getFFT(backend='scipy', wisdomFile=None, threads=1):
+   return FFT(backend, wisdomFile, threads)
@@ -0,0 +1,251 @@
+# IQ sources feeding the acquisition engine.
+# All sources deliver raw uint8 interleaved IQ bytes, as the RTL-SDR does,
+# so that the spectral pipeline is identical with or without hardware:
+# - RtlSdrSource: the RTL-SDR dongle, through pyrtlsdr
+# - FileSource: replay of a recorded raw IQ file
+# - SyntheticSource: Gaussian noise plus a configurable 21cm line
+
+import numpy as np
+import time, os
+import recording
+
+
+#####################################################
+# Base class
+
+class IQSource:
+   '''Interface of an IQ source.
+   Sub-classes implement readBytes, and may override
+   open, close, tune and stream.
+   generation is incremented at every retune,
+   so that the consumer can discard samples taken before the retune.
+   isRealTime is True if the source produces samples at its own pace,
+   in which case buffers are dropped rather than waited for.
+   '''
+   isRealTime = False
+
+   def __init__(self, sampleRate, centerFrequency):
+      self.sampleRate = sampleRate
+      self.centerFrequency = centerFrequency
+      self.generation = 0
+      self.cancelled = False
+
+   def open(self):
+      pass
+
+   def close(self):
+      pass
+
+   def tune(self, centerFrequency):
+      self.centerFrequency = centerFrequency
+      self.generation += 1
+
+   def readBytes(self, nByte):
+      '''Return nByte raw uint8 interleaved IQ bytes.
+      '''
+      raise NotImplementedError
+
+   def stream(self, callback, nByte):
+      '''Call callback(data) with successive buffers of nByte raw bytes,
+      until cancel is called. Blocking.
+      Call resume first to stream again after a cancel.
+      '''
+      while not self.cancelled:
+         callback(self.readBytes(nByte))
+
+   def cancel(self):
+      '''Stop the stream.
+      '''
+      self.cancelled = True
+
+   def resume(self):
+      '''Allow streaming again after a cancel.
+      Called before the reader thread starts,
+      so that a cancel sent right after the start is not lost.
+      '''
+      self.cancelled = False
+
+
+#####################################################
+# RTL-SDR dongle
+
+class RtlSdrSource(IQSource):
+   '''RTL-SDR dongle, read asynchronously through librtlsdr.
+   '''
+   isRealTime = True
+
+   def __init__(self, sampleRate, centerFrequency, gain, deviceIndex=0):
+      super().__init__(sampleRate, centerFrequency)
+      self.gain = gain
+      self.deviceIndex = deviceIndex
+      self.sdr = None
+      # True while librtlsdr is inside read_bytes_async
+      self.streaming = False
+
+   def open(self):
+      # To communicate with RTL SDR
+      from rtlsdr import RtlSdr
+      self.sdr = RtlSdr(device_index=self.deviceIndex)
+      self.sdr.sample_rate = self.sampleRate
+      self.sdr.center_freq = self.centerFrequency
+      self.sdr.gain = self.gain
+
+   def close(self):
+      if self.sdr is not None:
+         self.sdr.close()
+         self.sdr = None
+
+   def tune(self, centerFrequency):
+      self.sdr.center_freq = centerFrequency
+      super().tune(centerFrequency)
+
+   def readBytes(self, nByte):
+      return np.frombuffer(self.sdr.read_bytes(nByte), dtype=np.uint8)
+
+   def stream(self, callback, nByte):
+      # librtlsdr calls back with each USB transfer.
+      # A cancel sent before the async read started is caught by the next callback,
+      # since cancel_read_async fails (and closes the device) outside of an async read
+      def asyncCallback(data, context):
+         self.streaming = True
+         if self.cancelled:
+            self.sdr.cancel_read_async()
+            return
+         callback(np.frombuffer(data, dtype=np.uint8))
+      if self.cancelled:
+         return
+      try:
+         self.sdr.read_bytes_async(asyncCallback, nByte)
+      finally:
+         self.streaming = False
+
+   def cancel(self):
+      self.cancelled = True
+      if self.streaming:
+         self.sdr.cancel_read_async()
+
+
+#####################################################
+# Replay of a recorded IQ file
+
+class FileSource(IQSource):
+   '''Replay a raw uint8 interleaved IQ file, as recorded from the RTL-SDR.
+   The file is memory-mapped, and replayed in a loop if loop is True.
+   Retuning is not possible: the recorded center frequency is kept.
+   '''
+   def __init__(self, path, sampleRate, centerFrequency, loop=True):
+      super().__init__(sampleRate, centerFrequency)
+      self.path = path
+      self.loop = loop
+      self.data = None
+      self.position = 0
+
+   def open(self):
+      self.data = np.memmap(self.path, dtype=np.uint8, mode='r')
+      self.position = 0
+
+   def close(self):
+      self.data = None
+
+   def tune(self, centerFrequency):
+      if centerFrequency!=self.centerFrequency:
+         print("Cannot retune a recorded IQ file, keeping "+str(self.centerFrequency)+" Hz")
+      self.generation += 1
+
+   def readBytes(self, nByte):
+      # wrap around at the end of the file
+      if self.position + nByte > len(self.data):
+         if not self.loop:
+            raise EOFError("End of IQ file "+self.path)
+         self.position = 0
+      data = np.array(self.data[self.position:self.position + nByte])
+      self.position += nByte
+      return data
+
+
+#####################################################
+# Synthetic noise and 21cm line
+
+class SyntheticSource(IQSource):
+   '''Complex Gaussian noise with rms noiseLevel [full scale] per component,
+   plus a Gaussian 21cm line at lineFrequency [Hz],
+   of width lineWidth [Hz] and peak amplitude lineAmplitude relative to the noise,
+   quantized to uint8 like the RTL-SDR output.
+   If realTime is True, samples are produced at sampleRate.
+   '''
+   def __init__(self, sampleRate, centerFrequency, noiseLevel=0.2, lineFrequency=1420405751.768,
+                lineAmplitude=0.1, lineWidth=1.e5, realTime=False, seed=None):
+      super().__init__(sampleRate, centerFrequency)
+      self.noiseLevel = noiseLevel
+      self.lineFrequency = lineFrequency
+      self.lineAmplitude = lineAmplitude
+      self.lineWidth = lineWidth
+      self.realTime = realTime
+      self.isRealTime = realTime
+      self.rng = np.random.default_rng(seed)
+      self.shape = {}
+      self.tLast = None
+
+   def getShape(self, nSample):
+      '''Amplitude transfer function of the line,
+      cached for each buffer size and center frequency.
+      '''
+      key = (nSample, self.centerFrequency)
+      if key not in self.shape:
+         f = np.fft.fftfreq(nSample, d=1./self.sampleRate) + self.centerFrequency
+         profile = self.lineAmplitude * np.exp(-0.5 * ((f - self.lineFrequency) / self.lineWidth)**2)
+         self.shape[key] = np.sqrt(1. + profile).astype(np.float32)
+      return self.shape[key]
+
+   def readBytes(self, nByte):
+      nSample = nByte // 2
+      # white noise, colored by the line profile
+      noise = self.rng.standard_normal(2 * nSample, dtype=np.float32).view(np.complex64)
+      iq = np.fft.ifft(np.fft.fft(noise) * self.getShape(nSample))
+      iq *= self.noiseLevel
+      # quantize like the RTL-SDR
+      data = np.empty(2 * nSample, dtype=np.float32)
+      data[0::2] = iq.real
+      data[1::2] = iq.imag
+      data = np.clip(np.round(127.5 * (data + 1.)), 0, 255).astype(np.uint8)
+
+      # throttle to the sample rate if requested
+      if self.realTime:
+         tNow = time.time()
+         if self.tLast is not None:
+            time.sleep(max(0., self.tLast + nSample / self.sampleRate - tNow))
+         self.tLast = time.time()
+      return data
+
+
+#####################################################
+# Factory
+
+def getSource(param, centerFrequency=None, deviceIndex=None):
+   '''Create the IQ source selected by param['iqSource']:
+   'rtlsdr', 'file' or 'synthetic'.
+   '''
+   if centerFrequency is None:
+      centerFrequency = param['centerFrequency']
+   if deviceIndex is None:
+      deviceIndex = param['deviceIndex']
+
+   if param['iqSource']=='rtlsdr':
+      return RtlSdrSource(param['sampleRate'], centerFrequency, param['gain'], deviceIndex=deviceIndex)
+   elif param['iqSource']=='file':
+      # use the acquisition parameters of the recording, if available
+      sampleRate = param['sampleRate']
+      if os.path.exists(recording.getHeaderPath(param['iqFile'])):
+         header = recording.loadHeader(param['iqFile'])
+         sampleRate = header['sampleRate']
+         centerFrequency = header['centerFrequency']
+      return FileSource(param['iqFile'], sampleRate, centerFrequency)
+   elif param['iqSource']=='synthetic':
+      return SyntheticSource(param['sampleRate'], centerFrequency,
+                             noiseLevel=param['syntheticNoiseLevel'],
+                             lineFrequency=param['syntheticLineFrequency'],
+                             lineAmplitude=param['syntheticLineAmplitude'],
+                             lineWidth=param['syntheticLineWidth'],
+                             realTime=param['syntheticRealTime'])
+   else:
+      raise ValueError("Unknown IQ source "+str(param['iqSource']))
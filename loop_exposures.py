@@ -1,5 +1,6 @@
 #!/home/stellarmate/anaconda3/bin/python3
 import diy21cm as d21
+import output_writer
 
 # here is another change
    
@@ -13,49 +14,73 @@ d21.biasTOn()
 paramStart = d21.getDefaultParams()
 d21.setDate(paramStart)
 
+# Change exposure time if desired
+paramStart['integrationTime'] = 5*60  # [sec]
 
-# Take repeated exposures
-while(True):
+# Keep the SDR open and streaming across exposures,
+# so that consecutive exposures have no gap
+session = d21.openSession(paramStart)
 
-   try:
-      # For each exposure
-      param = d21.getDefaultParams()
+# Save the exposure files on a background thread,
+# while the session keeps integrating the next exposure
+writer = output_writer.OutputWriter(maxQueue=4)
 
-      # Change exposure time if desired
-      param['integrationTime'] = 5*60  # [sec]
 
-      d21.setExpType(param, 'on')
-      #V}d21.setExpType(param, 'foff')
-      #d21.setExpType(param, 'fswitch')
-      #d21.setExpType(param, 'cold')
-      #d21.setExpType(param, 'hot')
+# Take repeated exposures, until interrupted with ctrl-c
+try:
+   while(True):
 
+      try:
+         # For each exposure
+         param = d21.getDefaultParams()
 
-      # set the same date as the start ofthe observing session,
-      # and add 24 to the hours for each day elapsed
-      # this way all output files are in the same folder,
-      # even if we cross midnight
-      d21.setTimeSameDate(param, paramStart)
+         # Same exposure time as the session
+         param['integrationTime'] = paramStart['integrationTime']  # [sec]
 
-      d21.setMountInfo(param)
+         d21.setExpType(param, 'on')
+         #V}d21.setExpType(param, 'foff')
+         #d21.setExpType(param, 'fswitch')
+         #d21.setExpType(param, 'wideband')
+         #d21.setExpType(param, 'raw')
+         #d21.setExpType(param, 'cold')
+         #d21.setExpType(param, 'hot')
 
-      d21.setOutputFigDir(param)
-      d21.setFileName(param)
 
-      d21.takeExposure(param)
-      d21.attemptCalibration(param)
+         # set the same date as the start ofthe observing session,
+         # and add 24 to the hours for each day elapsed
+         # this way all output files are in the same folder,
+         # even if we cross midnight
+         d21.setTimeSameDate(param, paramStart)
 
-      d21.saveJson(param)
-      d21.savePlot(param)
+         # the mount info is read by the session at the start of each slice,
+         # or by takeExposure for the exposures that pause the session
+         d21.setNoMountInfo(param)
 
-      # take a screenshot for the timelapse
-      # after some time, so the open figures
-      # have time to update
-      d21.time.sleep(5) # delay in [sec]
-      d21.saveScreenshot(param)
+         d21.setOutputFigDir(param)
+         d21.setFileName(param)
 
-   except:
-      print("Something went wrong with this exposure. Trying again...")
+         # for exposures from the session, the time, mount info and file name
+         # are then replaced by those at the start of the slice
+         d21.takeExposure(param, session=session)
+         d21.attemptCalibration(param)
+
+         # save the exposure, append it to the session waterfall,
+         # update the running statistics, on the writer thread
+         writer.submit(d21.saveOutputs, param)
+
+         # save the plots and the screenshot for the timelapse,
+         # on the main thread, as pyplot is not thread-safe with GUI backends
+         d21.saveFigures(param)
+
+      except Exception:
+         print("Something went wrong with this exposure. Trying again...")
+
+finally:
+   # Write all the pending outputs
+   writer.close()
+
+   # Stop streaming and close the SDR
+   session.close()
 
 # Turn off bias T to power off LNA
 #d21.biasTOff()
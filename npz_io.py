@@ -0,0 +1,428 @@
+# Binary exposure files, replacing the json lists of json_io.
+# Each exposure is a numpy .npz archive:
+# every numpy array (fOn, pOn, pOff, tCalibrated*, ...) is stored
+# as its own typed .npy member, keeping its dtype and shape,
+# and all the scalar parameters are stored together as a json header member.
+# Loading a file only parses the small header,
+# and reads the arrays as raw binary.
+# The frequency axes, identical for all the exposures of a given configuration,
+# can be stored once per output folder, in axes/<hash>.npy,
+# and only referenced by their hash in the exposure header.
+# For long-term storage, the archive modes keep the spectra
+# in float32 or as scaled uint16, zlib-compressed,
+# which is still far more precise than the 8-bit RTL-SDR samples.
+
+import json
+import numpy as np
+import os, sys, struct, zipfile, hashlib
+import json_io
+
+
+# name of the member holding the scalar parameters
+headerName = '__header__'
+
+# frequency axes that can be shared between exposures,
+# and header entry holding their hashes
+axisNames = ['fOn', 'fOff', 'fFold']
+axesHeaderName = 'frequencyAxes'
+
+# header entry holding the offset and scale of the arrays stored as uint16
+quantizationHeaderName = 'quantization'
+
+
+def split_dict(data):
+   '''Split dict into scalar parameters and numpy arrays.
+   Lists are converted to numpy arrays, as in json_io.
+   '''
+   header = {}
+   arrays = {}
+   for key, value in data.items():
+      if isinstance(value, np.ndarray):
+         arrays[key] = value
+      elif isinstance(value, (list, tuple)):
+         arrays[key] = np.array(value)
+      elif isinstance(value, np.generic):
+         header[key] = value.item()
+      else:
+         header[key] = value
+   return header, arrays
+
+
+#####################################################
+# Shared frequency axes
+
+# axes already loaded, by path
+axisCache = {}
+
+
+def getAxisHash(f):
+   '''Hash of the frequency axis f [Hz].
+   The axis is fully set by the configuration (nBin, sampleRate,
+   centerFrequency, hops...), so its hash identifies that configuration.
+   '''
+   f = np.ascontiguousarray(f, dtype=np.float64)
+   return hashlib.sha1(f.tobytes()).hexdigest()[:16]
+
+
+def getAxisPath(folder, axisHash):
+   return os.path.join(folder, 'axes', axisHash+'.npy')
+
+
+def saveAxis(f, folder):
+   '''Save the frequency axis f once in folder/axes, if not already there.
+   Returns its hash.
+   '''
+   axisHash = getAxisHash(f)
+   path = getAxisPath(folder, axisHash)
+   if not os.path.exists(path):
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      # write then rename, so that readers never see a partial axis
+      pathTmp = path+'.'+str(os.getpid())+'.tmp'
+      with open(pathTmp, 'wb') as file:
+         np.save(file, np.asarray(f, dtype=np.float64))
+      os.replace(pathTmp, path)
+   return axisHash
+
+
+def loadAxis(folder, axisHash):
+   '''Frequency axis of hash axisHash, read once then cached, read-only.
+   '''
+   path = os.path.abspath(getAxisPath(folder, axisHash))
+   if path not in axisCache:
+      f = np.load(path)
+      f.flags.writeable = False
+      axisCache[path] = f
+   return axisCache[path]
+
+
+#####################################################
+# Exposure files
+
+def isFrequency(name):
+   '''Frequency arrays [Hz], e.g. fOn, fDevices, hopFrequencies,
+   which need double precision at 1.4 GHz.
+   '''
+   return (len(name) > 1 and name[0]=='f' and name[1].isupper()) or 'requenc' in name
+
+
+def archiveArrays(arrays, archive):
+   '''Reduce the precision of the floating point arrays, except the frequencies,
+   for the archive mode 'float32' or 'uint16'.
+   In 'uint16' mode, each finite array is scaled to the full uint16 range,
+   and its offset and scale are returned, to be kept in the header.
+   Arrays with non-finite values are stored as float32.
+   '''
+   quantization = {}
+   for name, array in arrays.items():
+      if not np.issubdtype(array.dtype, np.floating) or isFrequency(name) or array.size==0:
+         continue
+      if archive=='uint16' and np.all(np.isfinite(array)):
+         offset = float(np.min(array))
+         scale = float(np.max(array) - offset) / 65535.
+         if scale==0.:
+            scale = 1.
+         arrays[name] = np.round((array - offset) / scale).astype(np.uint16)
+         quantization[name] = [offset, scale]
+      else:
+         arrays[name] = array.astype(np.float32)
+   return quantization
+
+
+def restoreArray(array, quantization):
+   '''Undo the uint16 scaling of an archived array, given its [offset, scale].
+   '''
+   offset, scale = quantization
+   return array * scale + offset
+
+
+def saveNpz(param, path, shareAxes=False, archive=None):
+   '''Save param to the npz file path.
+   If shareAxes is True, the 1D frequency axes in axisNames,
+   and their rebinned levels, are saved once in the axes folder next to path,
+   and only their hashes are kept in the header.
+   archive is None to keep the full precision, uncompressed,
+   or 'float32' or 'uint16' to reduce the precision of the spectra
+   and compress the file.
+   '''
+   # separate the scalar parameters from the arrays
+   header, arrays = split_dict(param)
+   if shareAxes:
+      header[axesHeaderName] = {}
+      # the axes, and their pyramid levels, e.g. fOn_n256
+      for name in list(arrays.keys()):
+         if name.split('_')[0] in axisNames and arrays[name].ndim==1:
+            header[axesHeaderName][name] = saveAxis(arrays.pop(name), os.path.dirname(path))
+   if archive is not None:
+      header[quantizationHeaderName] = archiveArrays(arrays, archive)
+   arrays[headerName] = np.array(json.dumps(header))
+
+   # save all parameters and data
+   with open(path, 'wb') as f:
+      if archive is None:
+         np.savez(f, **arrays)
+      else:
+         np.savez_compressed(f, **arrays)
+
+
+def findExposure(pathStem):
+   '''Path of the exposure file pathStem.npz, or else pathStem.json,
+   or None if neither exists.
+   '''
+   for extension in ['.npz', '.json']:
+      if os.path.exists(pathStem+extension):
+         return pathStem+extension
+   return None
+
+
+def loadHeader(path):
+   '''Load only the scalar parameters.
+   '''
+   with np.load(path) as data:
+      return json.loads(str(data[headerName]))
+
+
+def loadNpz(path):
+   # load all parameters and data
+   with np.load(path) as data:
+      param = json.loads(str(data[headerName]))
+      for key in data.files:
+         if key!=headerName:
+            param[key] = data[key]
+   # rebuild the shared frequency axes
+   for name, axisHash in param.pop(axesHeaderName, {}).items():
+      param[name] = loadAxis(os.path.dirname(path), axisHash)
+   # restore the scaled arrays
+   for name, quantization in param.pop(quantizationHeaderName, {}).items():
+      param[name] = restoreArray(param[name], quantization)
+   return param
+
+
+#####################################################
+# Lazy loading
+
+def memmapMember(path, zipFile, name):
+   '''Memory-map the array stored in the member name of the npz file,
+   if it is stored uncompressed, as by saveNpz.
+   Returns None if the member cannot be memory-mapped.
+   '''
+   info = zipFile.getinfo(name)
+   if info.compress_type!=zipfile.ZIP_STORED:
+      return None
+   with open(path, 'rb') as f:
+      # skip the local file header, whose extra field may differ from the central directory
+      f.seek(info.header_offset)
+      localHeader = f.read(30)
+      nName, nExtra = struct.unpack('<HH', localHeader[26:30])
+      f.seek(info.header_offset + 30 + nName + nExtra)
+      # npy header, then the raw array
+      version = np.lib.format.read_magic(f)
+      if version==(1, 0):
+         shape, fortranOrder, dtype = np.lib.format.read_array_header_1_0(f)
+      else:
+         shape, fortranOrder, dtype = np.lib.format.read_array_header_2_0(f)
+      offset = f.tell()
+   if dtype.hasobject:
+      return None
+   if len(shape)==0 or 0 in shape:
+      return None
+   return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape,
+                    order='F' if fortranOrder else 'C')
+
+
+class LazyExposure:
+   '''Read-only handle on an exposure file.
+   The scalar parameters are parsed when the handle is created,
+   and are available in self.header.
+   Each array is loaded on first access, param[key],
+   memory-mapped for uncompressed npz files, then kept.
+   Archived files are compressed, so their arrays are decompressed instead.
+   Shared frequency axes are taken from the axis cache.
+   Json files have no separate header, so they are parsed in full
+   when the handle is created.
+   '''
+   def __init__(self, path):
+      self.path = path
+      self.arrays = {}
+      if path.endswith('.npz'):
+         with zipfile.ZipFile(path) as zipFile:
+            self.arrayNames = [name[:-len('.npy')] for name in zipFile.namelist()]
+         self.arrayNames.remove(headerName)
+         self.header = loadHeader(path)
+         self.axisHashes = self.header.pop(axesHeaderName, {})
+         self.quantization = self.header.pop(quantizationHeaderName, {})
+         self.arrayNames += list(self.axisHashes.keys())
+      else:
+         param = json_io.loadJson(path)
+         self.header, self.arrays = split_dict(param)
+         self.arrayNames = list(self.arrays.keys())
+         self.axisHashes = {}
+         self.quantization = {}
+
+   def keys(self):
+      return list(self.header.keys()) + self.arrayNames
+
+   def __contains__(self, key):
+      return key in self.header or key in self.arrayNames
+
+   def __getitem__(self, key):
+      if key in self.header:
+         return self.header[key]
+      if key not in self.arrayNames:
+         raise KeyError(key)
+      if key not in self.arrays and key in self.axisHashes:
+         self.arrays[key] = loadAxis(os.path.dirname(self.path), self.axisHashes[key])
+      if key not in self.arrays:
+         with zipfile.ZipFile(self.path) as zipFile:
+            array = memmapMember(self.path, zipFile, key+'.npy')
+            if array is None:
+               with zipFile.open(key+'.npy') as f:
+                  array = np.lib.format.read_array(f)
+         if key in self.quantization:
+            array = restoreArray(array, self.quantization[key])
+         self.arrays[key] = array
+      return self.arrays[key]
+
+   def get(self, key, default=None):
+      return self[key] if key in self else default
+
+   def load(self):
+      '''All parameters and data, as a dict.
+      '''
+      return {key: self[key] for key in self.keys()}
+
+
+#####################################################
+# Conversion of the json outputs
+
+def convertJson(pathJson, remove=False, shareAxes=True):
+   '''Convert a json_io exposure file to npz, next to it.
+   Returns the path of the npz file.
+   '''
+   pathNpz = pathJson[:-len(".json")]+".npz"
+   saveNpz(json_io.loadJson(pathJson), pathNpz, shareAxes=shareAxes)
+   if remove:
+      os.remove(pathJson)
+   return pathNpz
+
+
+def convertTree(pathRoot, remove=False, shareAxes=True):
+   '''Convert all the json exposure files in the folder pathRoot
+   and its sub-folders, e.g. the output folder.
+   Other json files, such as the sidecar headers of raw IQ recordings
+   or of the waterfalls, are left alone.
+   '''
+   nConverted = 0
+   for dirPath, dirNames, fileNames in os.walk(pathRoot):
+      for fileName in sorted(fileNames):
+         if fileName.endswith('.json') and not fileName.endswith('.iq.json'):
+            pathJson = os.path.join(dirPath, fileName)
+            if 'expType' not in json_io.loadJson(pathJson):
+               continue
+            convertJson(pathJson, remove=remove, shareAxes=shareAxes)
+            nConverted += 1
+   print("Converted "+str(nConverted)+" json files to npz in "+pathRoot)
+
+
+
+
+#####################################################
+# Archival of old sessions
+
+def getMaxRelativeError(param, paramArchived):
+   '''Maximum relative error over all the floating point arrays.
+   '''
+   maxError = 0.
+   for key, value in param.items():
+      value = np.asarray(value) if isinstance(value, (list, tuple, np.ndarray)) else None
+      if value is None or value.size==0 or not np.issubdtype(value.dtype, np.floating):
+         continue
+      archived = np.asarray(paramArchived[key], dtype=np.float64)
+      finite = np.isfinite(value) & (value!=0.)
+      if np.any(finite):
+         maxError = max(maxError, np.max(np.abs(archived[finite] / value[finite] - 1.)))
+   return maxError
+
+
+def archiveTree(pathRoot, archive='float32', dryRun=False):
+   '''Re-save all the json and npz exposure files in pathRoot and its sub-folders
+   in the archive mode archive, 'float32' or 'uint16', with shared frequency axes.
+   The original files are replaced, unless dryRun is True.
+   An exposure saved both as npz and json is archived once, from the npz file,
+   as in findExposure, and its json copy is removed.
+   Prints the total size ratio, and the maximum relative error introduced.
+   '''
+   sizeBefore = 0
+   sizeAfter = 0
+   maxError = 0.
+   nFile = 0
+   for dirPath, dirNames, fileNames in os.walk(pathRoot):
+      # one exposure per stem
+      stems = sorted(set(os.path.splitext(fileName)[0] for fileName in fileNames
+                         if fileName.endswith('.npz')
+                         or (fileName.endswith('.json') and not fileName.endswith('.iq.json'))))
+      for stem in stems:
+         pathStem = os.path.join(dirPath, stem)
+         path = findExposure(pathStem)
+         param = loadNpz(path) if path.endswith('.npz') else json_io.loadJson(path)
+         if 'expType' not in param:
+            continue
+         paths = [pathStem+extension for extension in ['.npz', '.json'] if os.path.exists(pathStem+extension)]
+
+         pathNew = pathStem+'.npz'
+         pathTmp = pathNew+'.'+str(os.getpid())+'.tmp'
+         saveNpz(param, pathTmp, shareAxes=True, archive=archive)
+         maxError = max(maxError, getMaxRelativeError(param, loadNpz(pathTmp)))
+         sizeBefore += sum(os.path.getsize(p) for p in paths)
+         sizeAfter += os.path.getsize(pathTmp)
+         nFile += 1
+
+         if dryRun:
+            os.remove(pathTmp)
+         else:
+            os.replace(pathTmp, pathNew)
+            for p in paths:
+               if p!=pathNew:
+                  os.remove(p)
+
+   print("Archived "+str(nFile)+" exposures in "+pathRoot+" as "+archive)
+   if nFile > 0:
+      print("Size "+str(sizeBefore)+" -> "+str(sizeAfter)+" bytes, ratio "+str(round(sizeBefore / sizeAfter, 2)))
+   print("Max relative error "+str(maxError))
+   return sizeBefore, sizeAfter, maxError
+
+
+#####################################################
+#####################################################
+#####################################################
+
+if __name__=="__main__":
+
+   # Archive an output folder, e.g.
+   # python npz_io.py archive ./output/20250525 uint16
+   # add --dry-run to only report the size ratio and the error
+   if len(sys.argv) > 2 and sys.argv[1]=='archive':
+      archive = sys.argv[3] if len(sys.argv) > 3 and sys.argv[3]!='--dry-run' else 'float32'
+      archiveTree(sys.argv[2], archive=archive, dryRun='--dry-run' in sys.argv)
+
+   # Convert an output folder, e.g. ./output/20250525
+   elif len(sys.argv) > 1:
+      convertTree(sys.argv[1])
+
+   else:
+      # Sample dictionary with mixed types
+      param = {
+          'int': 1,
+          'float': 2.5,
+          'str': 'example',
+          'array_1d': np.array([1, 2, 3]),
+          'array_2d': np.array([[1, 2], [3, 4]]),
+      }
+      print(param)
+
+      # save it to npz file
+      path = './test_npz_io.npz'
+      saveNpz(param, path)
+
+      # load the npz file back
+      param_read = loadNpz(path)
+      print(param_read)
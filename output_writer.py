@@ -0,0 +1,85 @@
+# Asynchronous output stage for the exposure loop.
+# Saving the exposure files runs on a single writer thread,
+# fed by a bounded queue, so that the loop moves on as soon as takeExposure returns.
+# Only submit file I/O: pyplot is not thread-safe with the GUI backends,
+# so the plots and screenshots stay on the main thread (see diy21cm.saveFigures).
+# If the writer falls behind by more than maxQueue exposures,
+# submit blocks, rather than piling up spectra in memory.
+
+import threading, queue, time
+import traceback
+
+
+class OutputWriter:
+   '''Run the submitted jobs in order, on a background thread.
+   Use close (or a with block) to wait for all the pending jobs
+   before the program exits.
+   '''
+   def __init__(self, maxQueue=4):
+      self.queue = queue.Queue(maxsize=maxQueue)
+      self.stats = {'nJobs': 0, 'nFailedJobs': 0, 'maxQueueDepth': 0,
+                    'totalWriteTime': 0., 'maxLatency': 0., 'submitWaitTime': 0.}
+      self.thread = threading.Thread(target=self.run, daemon=True)
+      self.thread.start()
+
+   def submit(self, function, *args, **kwargs):
+      '''Queue the call function(*args, **kwargs).
+      Blocks while the queue is full.
+      '''
+      tStart = time.time()
+      self.queue.put((function, args, kwargs, tStart))
+      self.stats['submitWaitTime'] += time.time() - tStart
+      self.stats['maxQueueDepth'] = max(self.stats['maxQueueDepth'], self.queue.qsize())
+
+   def run(self):
+      while True:
+         job = self.queue.get()
+         # sentinel from close
+         if job is None:
+            self.queue.task_done()
+            return
+         function, args, kwargs, tSubmit = job
+         tStart = time.time()
+         try:
+            function(*args, **kwargs)
+         except Exception:
+            self.stats['nFailedJobs'] += 1
+            print("Output job "+function.__name__+" failed:")
+            traceback.print_exc()
+         tStop = time.time()
+         # write time, and latency from submission to completion
+         self.stats['nJobs'] += 1
+         self.stats['totalWriteTime'] += tStop - tStart
+         self.stats['maxLatency'] = max(self.stats['maxLatency'], tStop - tSubmit)
+         print("Output job "+function.__name__+" done in "+str(round(tStop - tStart, 2))+" sec, "
+               +str(round(tStop - tSubmit, 2))+" sec after submission, "
+               +str(self.queue.qsize())+" jobs queued")
+         self.queue.task_done()
+
+   def flush(self):
+      '''Wait until all the submitted jobs are done.
+      '''
+      self.queue.join()
+
+   def close(self):
+      '''Finish all the pending jobs, then stop the writer thread.
+      '''
+      if self.thread.is_alive():
+         self.queue.put(None)
+         self.thread.join()
+      self.printStats()
+
+   def printStats(self):
+      stats = self.stats
+      print("Output writer: "+str(stats['nJobs'])+" jobs, "+str(stats['nFailedJobs'])+" failed")
+      if stats['nJobs'] > 0:
+         print("Mean write time "+str(round(stats['totalWriteTime'] / stats['nJobs'], 2))+" sec, "
+               +"max latency "+str(round(stats['maxLatency'], 2))+" sec")
+      print("Max queue depth "+str(stats['maxQueueDepth'])+", "
+            +"time blocked on a full queue "+str(round(stats['submitWaitTime'], 2))+" sec")
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, *exc):
+      self.close()
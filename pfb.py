@@ -0,0 +1,85 @@
+# Polyphase filter bank (PFB) channelizer.
+# Each output frame is the FFT of nTap consecutive blocks of nBin samples,
+# weighted by a windowed-sinc prototype filter and summed.
+# Compared to plain FFT binning, the channel response is much flatter
+# and sharper, so strong RFI and the DC spike leak far less
+# into the neighbouring channels of the faint 21cm line.
+
+import numpy as np
+from scipy import signal
+from functools import lru_cache
+import fft_plans
+
+
+@lru_cache(maxsize=None)
+def getPrototypeFilter(nBin, nTap, window='hann'):
+   '''Windowed-sinc prototype filter of nTap * nBin coefficients,
+   with a cutoff at the channel width,
+   reshaped as (nTap, nBin) polyphase branches.
+   '''
+   x = np.arange(nTap * nBin) / nBin - nTap / 2.
+   h = np.sinc(x) * signal.get_window(window, nTap * nBin, fftbins=False)
+   return h.reshape((nTap, nBin)).astype(np.float32)
+
+
+def pfbSpectra(iq, nBin, nTap, window='hann', fft=None):
+   '''PFB power spectra [same unit as |iq|^2] of all the frames in iq,
+   critically sampled, one frame every nBin samples.
+   iq must contain a whole number of blocks of nBin samples, at least nTap.
+   All frames are computed at once, with a single batched FFT.
+   Returns an array (nFrame, nBin), unshifted.
+   '''
+   if fft is None:
+      fft = fft_plans.getFFT()
+   h = getPrototypeFilter(nBin, nTap, window)
+   blocks = iq.reshape((-1, nBin))
+   # frames of nTap consecutive blocks, without copying: (nFrame, nBin, nTap)
+   frames = np.lib.stride_tricks.sliding_window_view(blocks, nTap, axis=0)
+   # polyphase filtering: weighted sum over the taps
+   filtered = np.einsum('fbt,tb->fb', frames, h)
+   X = fft(filtered.astype(np.complex64))
+   return X.real**2 + X.imag**2
+
+
+class PfbEstimator:
+   '''PFB estimator of the power spectral density [V^2/Hz],
+   normalized like the Welch density so both estimators agree on white noise.
+   The last nTap - 1 blocks of each buffer are kept,
+   so that consecutive buffers are channelized without losing frames.
+   Call reset after a retune.
+   '''
+   # the frames share input samples, but for noise their channel powers
+   # are nearly uncorrelated: the SK uses all of them
+   skFrameStride = 1
+
+   def __init__(self, nBin, sampleRate, nTap=4, window='hann', fft=None):
+      self.nBin = nBin
+      self.sampleRate = sampleRate
+      self.nTap = nTap
+      self.window = window
+      h = getPrototypeFilter(nBin, nTap, window)
+      self.norm = 1. / (sampleRate * np.sum(h.astype(np.float64)**2))
+      self.f = np.fft.fftfreq(nBin, d=1. / sampleRate)
+      self.fft = fft if fft is not None else fft_plans.getFFT()
+      self.reset()
+
+   def reset(self):
+      self.history = np.zeros(0, dtype=np.complex64)
+
+   def spectra(self, iq):
+      '''Power spectral densities p [V^2/Hz] of the frames of the buffer iq,
+      or of the batch of consecutive buffers iq (nBuffer, nSample),
+      continuing the frames of the previous buffer,
+      as an array (nFrame, nBin), unshifted.
+      The frequencies [Hz] relative to the center frequency are in self.f.
+      '''
+      # remove the DC offset of the dongle
+      iq = iq - np.mean(iq, axis=-1, keepdims=True)
+      x = np.concatenate((self.history, iq.ravel()))
+      nUsed = len(x) - len(x) % self.nBin
+      # not enough blocks yet for a single frame
+      if nUsed < self.nTap * self.nBin:
+         self.history = x
+         return np.zeros((0, self.nBin))
+      self.history = x[nUsed - (self.nTap - 1) * self.nBin:]
+      return pfbSpectra(x[:nUsed], self.nBin, self.nTap, self.window, fft=self.fft) * self.norm
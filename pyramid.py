@@ -0,0 +1,113 @@
+# Multi-resolution pyramid of the saved spectra.
+# Each spectrum is also saved rebinned by 2, 4, 8... in number of channels,
+# as e.g. pOn_n256 and fOn_n256 for 256 channels,
+# so that quick-look plots and overviews of many exposures
+# only read the coarsest level that still fills the plot width,
+# a few KB per exposure, instead of the full nBin channels.
+
+import numpy as np
+
+
+# spectra with a pyramid, by frequency axis
+pyramidKeys = {'fOn': ['pOn', 'pHot', 'pCold', 'tCalibratedHotCold', 'tCalibratedHot', 'tCalibratedCold'],
+               'fOff': ['pOff'],
+               'fFold': ['pFold']}
+
+
+def getLevelName(key, nChannel):
+   return key+'_n'+str(nChannel)
+
+
+def rebin(x, factor):
+   '''Average x over groups of factor consecutive channels, along the last axis.
+   The last channels are dropped if nBin is not a multiple of factor.
+   '''
+   x = np.asarray(x)
+   nChannel = x.shape[-1] // factor
+   x = x[..., :nChannel * factor]
+   return np.mean(x.reshape(x.shape[:-1] + (nChannel, factor)), axis=-1)
+
+
+def getFactor(nBin, nPixel):
+   '''Largest power of 2 rebinning factor leaving at least nPixel channels.
+   '''
+   factor = 1
+   while nBin // (2 * factor) >= nPixel:
+      factor *= 2
+   return factor
+
+
+def rebinToWidth(f, p, nPixel):
+   '''Rebin f and p to the coarsest power of 2 level with at least nPixel channels.
+   '''
+   factor = getFactor(np.shape(f)[-1], nPixel)
+   if factor==1:
+      return f, p
+   return rebin(f, factor), rebin(p, factor)
+
+
+def addPyramid(param, minBin=64):
+   '''Add to param the levels of the spectra in pyramidKeys,
+   rebinned by 2, 4, 8... down to at least minBin channels.
+   '''
+   for fKey, pKeys in pyramidKeys.items():
+      if fKey not in param or np.ndim(param[fKey])!=1:
+         continue
+      nBin = len(param[fKey])
+      factor = 2
+      while nBin // factor >= minBin:
+         nChannel = nBin // factor
+         param[getLevelName(fKey, nChannel)] = rebin(param[fKey], factor)
+         for pKey in pKeys:
+            if pKey in param and np.shape(param[pKey])==(nBin,):
+               param[getLevelName(pKey, nChannel)] = rebin(param[pKey], factor)
+         factor *= 2
+
+
+def getLevels(exposure, key):
+   '''Numbers of channels of the saved levels of key, in decreasing order.
+   Works with a dict or an npz_io.LazyExposure, without loading any array.
+   '''
+   prefix = key+'_n'
+   return sorted([int(name[len(prefix):]) for name in exposure.keys()
+                  if name.startswith(prefix) and name[len(prefix):].isdigit()], reverse=True)
+
+
+def getLevelKey(exposure, key, nPixel):
+   '''Name of the coarsest saved level of key with at least nPixel channels,
+   or key itself if there is none.
+   '''
+   levels = [n for n in getLevels(exposure, key) if n >= nPixel]
+   if len(levels)==0:
+      return key
+   return getLevelName(key, levels[-1])
+
+
+def getLevelArray(exposure, key, nPixel):
+   '''Array key of the exposure rebinned to the coarsest power of 2 level
+   with at least nPixel channels, as by rebinToWidth.
+   The level is read if it was saved, else rebinned from the full resolution array,
+   so that exposures saved with different pyramidMinBin, or without a pyramid,
+   give the same number of channels.
+   '''
+   levels = getLevels(exposure, key)
+   # the finest level has nBin // 2 channels, which sets the same factors as nBin
+   nBin = 2 * levels[0] if len(levels) > 0 else np.shape(exposure[key])[-1]
+   factor = getFactor(nBin, nPixel)
+   if factor==1:
+      return exposure[key]
+   levelName = getLevelName(key, nBin // factor)
+   if levelName in exposure:
+      return exposure[levelName]
+   return rebin(exposure[key], factor)
+
+
+def getSpectrum(exposure, pKey='pOn', fKey='fOn', nPixel=None):
+   '''Frequencies and spectrum pKey of the exposure,
+   at the coarsest level with at least nPixel channels, see getLevelArray,
+   or at full resolution if nPixel is None.
+   With an npz_io.LazyExposure, only that level is read, if it was saved.
+   '''
+   if nPixel is None:
+      return exposure[fKey], exposure[pKey]
+   return getLevelArray(exposure, fKey, nPixel), getLevelArray(exposure, pKey, nPixel)
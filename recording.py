@@ -0,0 +1,181 @@
+# Raw IQ recordings and their offline reprocessing.
+# A 'raw' exposure writes the uint8 interleaved IQ stream to a .iq file,
+# next to a small json header with the acquisition parameters,
+# and the stream index of each recorded buffer, in .iq.index.npy,
+# since the buffers dropped by a lagging consumer leave gaps in the stream.
+# The recordings can later be reprocessed with any number of bins,
+# window or flagging, by memory-mapping them and computing
+# the spectra in bounded chunks of vectorized FFTs.
+
+import numpy as np
+import os
+import json_io as json
+import fft_plans
+from spectral import getFrames, welchFrames
+
+
+# acquisition parameters copied to the header of the recordings
+headerKeys = ['dateCapture', 'timeCapture', 'expType', 'nSample', 'nBin', 'gain', 'sampleRate',
+              'centerFrequency', 'integrationTime', 'deviceIndex', 'ra', 'dec', 'lat', 'lon',
+              'timeStartEpoch', 'timeStopEpoch', 'nProcessedBuffers', 'nDroppedBuffers']
+
+
+def getRawPath(param):
+   '''Path of the raw IQ recording of the exposure.
+   '''
+   return param['pathOut']+"/"+param['fileName']+".iq"
+
+
+def getHeaderPath(path):
+   '''Path of the json header of the raw IQ recording at path.
+   '''
+   return path+".json"
+
+
+def saveHeader(param, path):
+   '''Save the acquisition parameters of the raw IQ recording at path.
+   '''
+   header = {key: param[key] for key in headerKeys if key in param}
+   header['format'] = 'uint8 interleaved IQ'
+   json.saveJson(header, getHeaderPath(path))
+
+
+def loadHeader(path):
+   '''Load the acquisition parameters of the raw IQ recording at path.
+   '''
+   return json.loadJson(getHeaderPath(path))
+
+
+def getIndexPath(path):
+   '''Path of the buffer indices of the raw IQ recording at path.
+   '''
+   return path+".index.npy"
+
+
+def saveBufferIndices(indices, path):
+   '''Save the stream index of each buffer of the raw IQ recording at path,
+   see acquisition.Pipeline.integrate.
+   '''
+   np.save(getIndexPath(path), np.asarray(indices, dtype=np.int64))
+
+
+def getSegments(path, nSampleTotal, nSampleBuffer):
+   '''Contiguous segments of the raw IQ recording at path,
+   as a list of (start, stop, streamStart) [samples]:
+   the samples start:stop of the file follow each other in the stream,
+   and start at the stream position streamStart.
+   Recordings without buffer indices are one contiguous segment.
+   '''
+   if not os.path.exists(getIndexPath(path)):
+      return [(0, nSampleTotal, 0)]
+   indices = np.load(getIndexPath(path))
+   # first buffer of each segment, after each gap
+   iStarts = np.concatenate(([0], np.where(np.diff(indices)!=1)[0] + 1))
+   iStops = np.concatenate((iStarts[1:], [len(indices)]))
+   return [(iStart * nSampleBuffer, min(iStop * nSampleBuffer, nSampleTotal), indices[iStart] * nSampleBuffer)
+           for iStart, iStop in zip(iStarts, iStops)]
+
+
+#####################################################
+# Offline reprocessing
+
+def reprocessRaw(path, nBin=None, window='hann', flag=None, timeResolution=None, nSampleChunk=2**20):
+   '''Recompute the power spectrum of the raw IQ recording at path,
+   with nBin frequency bins (by default the recorded one),
+   and window (any scipy.signal.get_window window).
+   flag, if given, is a function taking a block of spectra (nFrame, nBin)
+   and returning a boolean array of the same shape, True for the cells to drop.
+   The file is memory-mapped and processed in chunks of nSampleChunk samples,
+   so memory stays bounded for recordings of any size.
+   No frame straddles a gap left by dropped buffers, see getSegments.
+   If timeResolution [sec] is given, returns one spectrum per time bin,
+   rounded to whole chunks, with the time measured along the stream, gaps included.
+   Time bins entirely lost to dropped buffers are nan.
+   Returns f [Hz], p [V^2/Hz] (nBin,) or (nTime, nBin),
+   and the fraction of cells flagged in each frequency bin.
+   '''
+   header = loadHeader(path)
+   if nBin is None:
+      nBin = header['nBin']
+   sampleRate = header['sampleRate']
+   data = np.memmap(path, dtype=np.uint8, mode='r')
+   nSampleTotal = len(data) // 2
+
+   # whole number of frames per chunk
+   nSampleChunk = max(nBin, nSampleChunk - nSampleChunk % nBin)
+   if timeResolution is None:
+      nSamplePerTime = None
+   else:
+      nSamplePerTime = max(1, int(round(timeResolution * sampleRate / nSampleChunk))) * nSampleChunk
+   win = fft_plans.getWindow(window, nBin)
+
+   # sums by time bin
+   pSum = {}
+   nSum = {}
+   nFlaggedTot = np.zeros(nBin)
+   nTot = 0
+   for start, stop, streamStart in getSegments(path, nSampleTotal, header['nSample']):
+      position = start
+      while stop - position >= nBin:
+         # cut the chunks at the ends of the segment and of the time bins
+         streamPosition = streamStart + position - start
+         iTime = 0 if nSamplePerTime is None else streamPosition // nSamplePerTime
+         chunkStop = min(position + nSampleChunk, stop)
+         if nSamplePerTime is not None:
+            chunkStop = min(chunkStop, position + (iTime + 1) * nSamplePerTime - streamPosition)
+         chunkStart = position
+         position = chunkStop
+         if chunkStop - chunkStart < nBin:
+            continue
+         # convert to IQ in [-1, 1]
+         iq = data[2 * chunkStart:2 * chunkStop].astype(np.float32).view(np.complex64)
+         iq /= 127.5
+         iq -= (1. + 1.j)
+
+         spectra = welchFrames(getFrames(iq, nBin), win, sampleRate)
+         if iTime not in pSum:
+            pSum[iTime] = np.zeros(nBin)
+            nSum[iTime] = np.zeros(nBin)
+         if flag is None:
+            pSum[iTime] += np.sum(spectra, axis=0)
+            nSum[iTime] += spectra.shape[0]
+         else:
+            mask = flag(spectra)
+            pSum[iTime] += np.sum(np.where(mask, 0., spectra), axis=0)
+            nSum[iTime] += np.sum(~mask, axis=0)
+            nFlaggedTot += np.sum(mask, axis=0)
+         nTot += spectra.shape[0]
+
+   pTimes = np.full((max(pSum.keys(), default=0) + 1, nBin), np.nan)
+   for iTime in pSum:
+      pTimes[iTime] = pSum[iTime] / nSum[iTime]
+
+   # Shift frequency spectra back to the intended range
+   f = fft_plans.getFrequencyAxis(nBin, sampleRate, header['centerFrequency'])
+   p = np.fft.fftshift(np.array(pTimes), axes=-1)
+   if timeResolution is None:
+      p = p[0]
+   flagFraction = np.fft.fftshift(nFlaggedTot / max(nTot, 1))
+   return f, p, flagFraction
+
+
+#####################################################
+#####################################################
+#####################################################
+
+if __name__=="__main__":
+
+   # Reprocess a raw IQ recording with a different number of bins
+   import sys
+   path = sys.argv[1]
+   nBin = int(sys.argv[2]) if len(sys.argv) > 2 else None
+   f, p, flagFraction = reprocessRaw(path, nBin=nBin)
+
+   # save next to the recording
+   param = loadHeader(path)
+   param['nBin'] = len(f)
+   param['fOn'] = f
+   param['pOn'] = p
+   pathOut = path[:-len(".iq")]+"_reprocessed_"+str(len(f))+"bins.json"
+   json.saveJson(param, pathOut)
+   print("Reprocessed "+path+" with "+str(len(f))+" bins, saved to "+pathOut)
@@ -0,0 +1,166 @@
+# Regridding of spectra onto a common velocity grid,
+# to stack exposures taken at different center frequencies,
+# throw frequencies or velocity corrections.
+# Each output channel is the average of the input channels it overlaps,
+# weighted by the overlap, so the integral of the spectrum is conserved.
+# The resampling is a sparse matrix (nOut, nIn), built once per pair
+# of input axis and output grid, then cached,
+# so that a whole stack of spectra on the same axis is regridded with one sparse product.
+# Spectra on different axes, e.g. with per-exposure velocity corrections,
+# are regridded with one block-diagonal sparse matrix, built in one vectorized pass.
+
+import numpy as np
+import scipy.sparse
+import hashlib
+import velocity_frames
+
+
+# resampling matrices already built, by (input axis, output grid) hashes,
+# the oldest ones dropped beyond maxCache
+matrixCache = {}
+maxCache = 64
+# number of spectra per block-diagonal matrix in regridRows, to bound the memory
+nRowPerBlock = 1024
+
+
+def getHash(x):
+   x = np.ascontiguousarray(x, dtype=np.float64)
+   return hashlib.sha1(x.tobytes()).hexdigest()
+
+
+def getBinEdges(x):
+   '''Edges (n+1,) of the channels centered on x (n,), increasing or decreasing,
+   half way between neighbouring centers.
+   '''
+   x = np.asarray(x, dtype=np.float64)
+   middle = 0.5 * (x[1:] + x[:-1])
+   return np.concatenate(([x[0] - (middle[0] - x[0])], middle, [x[-1] + (x[-1] - middle[-1])]))
+
+
+def getVelocityGrid(vMin, vMax, dv):
+   '''Centers [m/s] of the channels of width dv [m/s] from vMin to vMax.
+   '''
+   return np.arange(vMin, vMax + 0.5 * dv, dv)
+
+
+def getBinEdgesRows(X):
+   '''Edges (nRow, n+1) of the channels centered on each row of X (nRow, n), see getBinEdges.
+   '''
+   X = np.asarray(X, dtype=np.float64)
+   middle = 0.5 * (X[:, 1:] + X[:, :-1])
+   return np.concatenate((X[:, :1] - (middle[:, :1] - X[:, :1]), middle,
+                          X[:, -1:] + (X[:, -1:] - middle[:, -1:])), axis=1)
+
+
+def buildBlockMatrix(XIn, xOut):
+   '''Block-diagonal sparse matrix (nRow*nOut, nRow*nIn), whose block i averages
+   the input channels centered on XIn[i] (nRow, nIn) into the output channels centered on xOut,
+   weighted by their overlap. All the rows are handled in one vectorized pass.
+   Output channels not fully covered by the input channels get nan,
+   through the returned boolean array covered (nRow, nOut).
+   '''
+   XIn = np.atleast_2d(np.asarray(XIn, dtype=np.float64))
+   nRow, nIn = XIn.shape
+   nOut = len(xOut)
+   edgesIn = getBinEdgesRows(XIn)
+   edgesOut = getBinEdges(xOut)
+   # work with increasing edges, and map back to the channel indices
+   decreasing = edgesIn[:, -1] < edgesIn[:, 0]
+   edgesIn[decreasing] = edgesIn[decreasing, ::-1]
+   iOut = np.arange(nOut)
+   if edgesOut[-1] < edgesOut[0]:
+      edgesOut, iOut = edgesOut[::-1], iOut[::-1]
+
+   # cut each row at all the edges: each segment lies in one input and one output channel,
+   # given by the number of input and output edges below it
+   edges = np.concatenate((edgesIn, np.broadcast_to(edgesOut, (nRow, nOut + 1))), axis=1)
+   order = np.argsort(edges, axis=1, kind='stable')
+   edges = np.take_along_axis(edges, order, axis=1)
+   isIn = order <= nIn
+   jIn = np.cumsum(isIn, axis=1)[:, :-1] - 1
+   jOut = np.cumsum(~isIn, axis=1)[:, :-1] - 1
+   length = np.diff(edges, axis=1)
+   row = np.broadcast_to(np.arange(nRow)[:, np.newaxis], length.shape)
+   inside = (jIn >= 0) & (jIn < nIn) & (jOut >= 0) & (jOut < nOut) & (length > 0.)
+   jIn, jOut, length, row = jIn[inside], jOut[inside], length[inside], row[inside]
+   iIn = np.where(decreasing[row], nIn - 1 - jIn, jIn)
+
+   widthOut = np.diff(edgesOut)
+   matrix = scipy.sparse.coo_matrix((length / widthOut[jOut], (row * nOut + iOut[jOut], row * nIn + iIn)),
+                                    shape=(nRow * nOut, nRow * nIn)).tocsr()
+   # fraction of each output channel covered by the input channels
+   coverage = np.asarray(matrix.sum(axis=1)).reshape(nRow, nOut)
+   covered = coverage > 1. - 1.e-6
+   return matrix, covered
+
+
+def buildResamplingMatrix(xIn, xOut):
+   '''Sparse matrix (nOut, nIn) averaging the input channels centered on xIn
+   into the output channels centered on xOut, weighted by their overlap.
+   Output channels not fully covered by the input channels get nan,
+   through the returned boolean array covered (nOut,).
+   '''
+   matrix, covered = buildBlockMatrix(xIn, xOut)
+   return matrix, covered[0]
+
+
+def getResamplingMatrix(xIn, xOut):
+   '''Resampling matrix and coverage for this input axis and output grid,
+   built once then cached, among the last maxCache ones.
+   '''
+   key = (getHash(xIn), getHash(xOut))
+   if key not in matrixCache:
+      if len(matrixCache) >= maxCache:
+         matrixCache.pop(next(iter(matrixCache)))
+      matrixCache[key] = buildResamplingMatrix(xIn, xOut)
+   return matrixCache[key]
+
+
+def regrid(xIn, p, xOut):
+   '''Regrid the spectra p, (nIn,) or (nSpectrum, nIn), all on the axis xIn,
+   onto the channels centered on xOut, conserving the integral.
+   The output channels not fully covered by xIn are nan.
+   Returns an array (nOut,) or (nSpectrum, nOut).
+   '''
+   matrix, covered = getResamplingMatrix(xIn, xOut)
+   p = np.asarray(p, dtype=np.float64)
+   pOut = (matrix @ p.T).T
+   pOut[..., ~covered] = np.nan
+   return pOut
+
+
+def regridRows(XIn, p, xOut):
+   '''Regrid each spectrum p[i] (nSpectrum, nIn), on its own axis XIn[i] (nSpectrum, nIn),
+   onto the channels centered on xOut, conserving the integral.
+   The output channels not fully covered by XIn[i] are nan.
+   The spectra are regridded by blocks of nRowPerBlock, with one block-diagonal sparse product each.
+   Returns an array (nSpectrum, nOut).
+   '''
+   p = np.asarray(p, dtype=np.float64)
+   pOut = np.empty((p.shape[0], len(xOut)))
+   for iStart in range(0, p.shape[0], nRowPerBlock):
+      I = slice(iStart, iStart + nRowPerBlock)
+      matrix, covered = buildBlockMatrix(XIn[I], xOut)
+      pBlock = (matrix @ p[I].ravel()).reshape(covered.shape)
+      pBlock[~covered] = np.nan
+      pOut[I] = pBlock
+   return pOut
+
+
+def regridToVelocity(f, p, vGrid, vCorrection=0.):
+   '''Regrid the spectra p (nSpectrum, nBin) at the frequencies f [Hz],
+   (nBin,) shared or (nSpectrum, nBin), onto the velocity grid vGrid [m/s],
+   radio convention, after adding the velocity corrections vCorrection [m/s],
+   scalar or (nSpectrum,), e.g. from velocity_frames.getVelocityCorrection.
+   If all the spectra share the same velocity axis, they are regridded
+   with the cached resampling matrix, else with regridRows.
+   Returns an array (nSpectrum, nVelocity).
+   '''
+   p = np.atleast_2d(p)
+   f = np.broadcast_to(f, p.shape)
+   vCorrection = np.broadcast_to(np.asarray(vCorrection, dtype=np.float64), (p.shape[0],))
+   v = velocity_frames.getRadioVelocity(f) + vCorrection[:, np.newaxis]
+
+   if np.all(v==v[0]):
+      return regrid(v[0], p, vGrid)
+   return regridRows(v, p, vGrid)
@@ -0,0 +1,104 @@
+# Online RFI excision with the spectral kurtosis (SK) estimator.
+# For Gaussian noise, such as the sky and the 21cm line,
+# the power in each channel is exponentially distributed and SK = 1.
+# Bursty or continuous-wave interference pushes SK away from 1,
+# so the corresponding block/channel cells are dropped before averaging.
+# See Nita & Gary 2010, MNRAS 406, L60.
+
+import numpy as np
+
+
+def spectralKurtosis(s1, s2, m):
+   '''Generalized SK estimator, from the sums over m frames
+   of the power s1 and of the squared power s2, in each channel.
+   Vectorized over any shape of s1, s2.
+   '''
+   return (m + 1.) / (m - 1.) * (m * s2 / s1**2 - 1.)
+
+
+def flagSpectralKurtosis(sk, m, nSigma):
+   '''Flag the cells whose SK deviates from 1 by more than
+   nSigma times its standard deviation sqrt(4/m) for Gaussian noise.
+   This assumes the m frames are independent, e.g. not overlapping.
+   '''
+   return np.abs(sk - 1.) > nSigma * np.sqrt(4. / m)
+
+
+class SKAccumulator:
+   '''Accumulate the power spectra of the frames into blocks,
+   and when a block is closed, drop the channels flagged by the SK,
+   if enabled and if the block holds at least minFrames frames for the SK.
+   The SK only uses every frameStride-th frame, e.g. 2 for the half-overlapping
+   Welch frames, so that its frames are independent, as flagSpectralKurtosis assumes.
+   All the frames are averaged.
+   '''
+   def __init__(self, nBin, nSigma=4., enabled=True, minFrames=16, frameStride=1):
+      self.nBin = nBin
+      self.nSigma = nSigma
+      self.enabled = enabled
+      self.minFrames = minFrames
+      self.frameStride = frameStride
+      self.reset()
+
+   def reset(self):
+      self.pSum = np.zeros(self.nBin)
+      self.nFrame = 0
+      self.s1 = np.zeros(self.nBin)
+      self.s2 = np.zeros(self.nBin)
+      self.m = 0
+
+   def add(self, spectra):
+      '''Add the spectra (nFrame, nBin) of one buffer to the current block.
+      '''
+      self.pSum += np.sum(spectra, axis=0)
+      self.nFrame += spectra.shape[0]
+      if self.enabled:
+         # frames of the same buffer only overlap their neighbours
+         independent = spectra[::self.frameStride]
+         self.s1 += np.sum(independent, axis=0)
+         self.s2 += np.sum(independent**2, axis=0)
+         self.m += independent.shape[0]
+
+   def close(self):
+      '''Close the current block.
+      Returns the sum of the unflagged spectra, the number of unflagged frames
+      in each channel, and the mask of flagged channels.
+      '''
+      if self.enabled and self.m >= self.minFrames:
+         mask = flagSpectralKurtosis(spectralKurtosis(self.s1, self.s2, self.m), self.m, self.nSigma)
+      else:
+         mask = np.zeros(self.nBin, dtype=bool)
+      pSum = np.where(mask, 0., self.pSum)
+      nFrame = np.where(mask, 0, self.nFrame)
+      self.reset()
+      return pSum, nFrame, mask
+
+
+def unpackMask(param):
+   '''Boolean RFI mask (nBlock, nBin) of an exposure,
+   True for the dropped block/channel cells,
+   with the channels in the same order as pOn.
+   '''
+   mask = np.unpackbits(np.asarray(param['rfiMaskPacked'], dtype=np.uint8), axis=-1, count=param['nBin'])
+   return mask.astype(bool)
+
+
+def getSKFlag(nFramePerBlock, nSigma=4., frameStride=2):
+   '''Flagging function for recording.reprocessRaw:
+   computes the SK over consecutive blocks of nFramePerBlock frames,
+   and flags all the frames of the flagged block/channel cells.
+   As in SKAccumulator, the SK only uses every frameStride-th frame,
+   2 for the half-overlapping Welch frames of reprocessRaw.
+   '''
+   def flag(spectra):
+      nFrame, nBin = spectra.shape
+      nBlock = int(np.ceil(nFrame / nFramePerBlock))
+      # pad with nan to a whole number of blocks, ignored in the sums
+      padded = np.full((nBlock * nFramePerBlock, nBin), np.nan)
+      padded[:nFrame] = spectra
+      blocks = padded.reshape((nBlock, nFramePerBlock, nBin))[:, ::frameStride]
+      m = np.sum(np.isfinite(blocks[:, :, 0]), axis=1)[:, np.newaxis]
+      sk = spectralKurtosis(np.nansum(blocks, axis=1), np.nansum(blocks**2, axis=1), m)
+      mask = flagSpectralKurtosis(sk, m, nSigma) & (m >= 16)
+      return np.repeat(mask, nFramePerBlock, axis=0)[:nFrame]
+   return flag
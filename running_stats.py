@@ -0,0 +1,178 @@
+# Running mean and variance of the spectra, per sky bin,
+# updated as each exposure completes, for deep spectra over long sessions.
+# The exposures are grouped by local sidereal time (LST) bin,
+# i.e. by the patch of sky crossing the beam of a fixed antenna,
+# or by pointing (ra, dec) for a tracking mount.
+# Each bin is updated with Welford's algorithm, numerically stable,
+# in O(nBin) per exposure, without re-reading the past exposures.
+# Each bin is stored as a small .npy file [count, mean (nBin), m2 (nBin)],
+# replaced atomically at each update,
+# in one folder per frequency axis (getStatsPath).
+
+import numpy as np
+import os
+import npz_io
+
+
+#####################################################
+# Welford accumulator
+
+class RunningStats:
+   '''Running count, mean and sum of squared deviations m2
+   of spectra of nBin channels.
+   '''
+   def __init__(self, nBin):
+      self.count = 0
+      self.mean = np.zeros(nBin)
+      self.m2 = np.zeros(nBin)
+
+   def update(self, p):
+      '''Add one spectrum p (nBin,).
+      '''
+      self.count += 1
+      delta = p - self.mean
+      self.mean += delta / self.count
+      self.m2 += delta * (p - self.mean)
+
+   def merge(self, other):
+      '''Add all the spectra of the RunningStats other,
+      with the parallel algorithm of Chan et al.
+      '''
+      count = self.count + other.count
+      if count==0:
+         return
+      delta = other.mean - self.mean
+      self.mean = self.mean + delta * other.count / count
+      self.m2 = self.m2 + other.m2 + delta**2 * self.count * other.count / count
+      self.count = count
+
+   @property
+   def variance(self):
+      '''Sample variance of the spectra [same unit as p^2], per channel.
+      '''
+      if self.count < 2:
+         return np.full_like(self.mean, np.nan)
+      return self.m2 / (self.count - 1)
+
+   @property
+   def errorOnMean(self):
+      return np.sqrt(self.variance / self.count)
+
+   def toArray(self):
+      return np.concatenate(([self.count], self.mean, self.m2))
+
+   @classmethod
+   def fromArray(cls, a):
+      nBin = (len(a) - 1) // 2
+      stats = cls(nBin)
+      stats.count = int(a[0])
+      stats.mean = np.array(a[1:1 + nBin])
+      stats.m2 = np.array(a[1 + nBin:])
+      return stats
+
+
+#####################################################
+# Sky bins
+
+def getLocalSiderealTime(timeEpoch, lon):
+   '''Local sidereal time [hour] at the time timeEpoch [sec since Unix epoch],
+   at longitude lon [deg, East positive].
+   Vectorized. Accurate to about a second, plenty for binning.
+   '''
+   # days since J2000.0
+   d = np.asarray(timeEpoch) / 86400. + 2440587.5 - 2451545.0
+   gmst = 18.697374558 + 24.06570982441908 * d # [hour]
+   return np.mod(gmst + np.asarray(lon) / 15., 24.)
+
+
+def getBinName(param, binning='lst', lstBinWidth=0.25, raResolution=0.1, decResolution=1.):
+   '''Name of the sky bin of the exposure:
+   for binning 'lst', the start of its LST bin of width lstBinWidth [hour],
+   using the longitude from the mount, or Greenwich if unknown;
+   for binning 'pointing', its (ra, dec) rounded to raResolution [hour] and decResolution [deg].
+   '''
+   if binning=='lst':
+      lon = param.get('lon')
+      if lon is None or not np.isfinite(lon):
+         lon = 0.
+      lst = getLocalSiderealTime(param['timeEpoch'], lon)
+      lstBin = np.floor(lst / lstBinWidth) * lstBinWidth
+      return "lst{:06.3f}".format(lstBin)
+   elif binning=='pointing':
+      ra = np.round(param['ra'] / raResolution) * raResolution
+      dec = np.round(param['dec'] / decResolution) * decResolution
+      return "ra{:.3f}_dec{:+.3f}".format(ra, dec)
+   else:
+      raise ValueError("Unknown binning "+str(binning))
+
+
+#####################################################
+# Storage
+
+def getStatsPath(pathRoot, f, binning='lst'):
+   '''Folder of the statistics of the on spectra at frequencies f [Hz], grouped by binning,
+   e.g. ./output/stats/on_lst_<hash of f>, see npz_io.getAxisHash,
+   so that a new centerFrequency, sampleRate or nBin starts new statistics.
+   '''
+   return os.path.join(pathRoot, 'on_'+binning+'_'+npz_io.getAxisHash(f))
+
+
+def getBinPath(pathStats, binName):
+   return os.path.join(pathStats, binName+'.npy')
+
+
+def loadBin(pathStats, binName, nBin):
+   path = getBinPath(pathStats, binName)
+   if os.path.exists(path):
+      return RunningStats.fromArray(np.load(path))
+   return RunningStats(nBin)
+
+
+def saveBin(pathStats, binName, stats):
+   path = getBinPath(pathStats, binName)
+   pathTmp = path+'.'+str(os.getpid())+'.tmp'
+   with open(pathTmp, 'wb') as f:
+      np.save(f, stats.toArray())
+   os.replace(pathTmp, path)
+
+
+def update(pathStats, binName, f, p):
+   '''Add the spectrum p at frequencies f [Hz] to the bin binName
+   of the statistics in the folder pathStats.
+   The frequencies are saved once, and must match.
+   '''
+   if not os.path.exists(pathStats):
+      os.makedirs(pathStats)
+   pathF = os.path.join(pathStats, 'frequencies.npy')
+   if os.path.exists(pathF):
+      if npz_io.getAxisHash(np.load(pathF))!=npz_io.getAxisHash(f):
+         raise ValueError("Frequencies differ from those of the statistics in "+pathStats)
+   else:
+      np.save(pathF, np.asarray(f, dtype=np.float64))
+
+   stats = loadBin(pathStats, binName, len(p))
+   stats.update(np.asarray(p, dtype=np.float64))
+   saveBin(pathStats, binName, stats)
+   return stats
+
+
+def loadStats(pathStats):
+   '''Frequencies [Hz] and dict of RunningStats, by bin name,
+   of the statistics in the folder pathStats.
+   '''
+   f = np.load(os.path.join(pathStats, 'frequencies.npy'))
+   stats = {}
+   for fileName in sorted(os.listdir(pathStats)):
+      if fileName.endswith('.npy') and fileName!='frequencies.npy':
+         stats[fileName[:-len('.npy')]] = RunningStats.fromArray(np.load(os.path.join(pathStats, fileName)))
+   return f, stats
+
+
+def getDeepSpectrum(pathStats):
+   '''Frequencies [Hz] and RunningStats of all the bins merged together.
+   '''
+   f, stats = loadStats(pathStats)
+   total = RunningStats(len(f))
+   for binStats in stats.values():
+      total.merge(binStats)
+   return f, total
@@ -0,0 +1,72 @@
+import numpy as np
+from time import time
+from scipy import signal
+
+# Modules from the parent folder
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import iq_sources
+import spectral
+import fft_plans
+from acquisition import bytesToIQ
+
+
+############################################################
+# 21cm rest-frame frequency
+nu21cm = 1420405751.768 # [Hz]
+
+# Exposure parameters
+nSample = 8192 # samples per buffer
+nBin = 512 # number of freq bins for power spectrum
+sampleRate = 2.32e6 # [Hz]
+nBuffer = 1024 # number of buffers to process
+
+
+############################################################
+# Same raw IQ buffers for all the paths
+
+source = iq_sources.SyntheticSource(sampleRate, nu21cm, seed=0)
+data = np.array([source.readBytes(2 * nSample) for i in range(nBuffer)])
+
+def printThroughput(name, tStart, tStop):
+   print(name+": "+str(round(nBuffer * nSample / (tStop - tStart) / 1.e6, 2))+" MS/s, "
+         +str(round(nBuffer * nSample / (tStop - tStart) / sampleRate, 1))+" times real time")
+
+
+############################################################
+# Current per-chunk path, as in rtlobs: one scipy.signal.welch call per buffer
+
+tStart = time()
+pTot = np.zeros(nBin)
+for i in range(nBuffer):
+   f, p = signal.welch(bytesToIQ(data[i]).astype(np.complex128), fs=sampleRate, nperseg=nBin, return_onesided=False)
+   pTot += p
+tStop = time()
+pRef = pTot / nBuffer
+printThroughput("Per-chunk scipy.signal.welch", tStart, tStop)
+
+
+############################################################
+# Batched path, with cached windows and FFT plans, in complex64
+
+backends = ['scipy']
+if fft_plans.pyfftw is not None:
+   backends.append('fftw')
+
+for backend in backends:
+   estimator = spectral.WelchEstimator(nBin, sampleRate, fft=fft_plans.getFFT(backend))
+   for nBatch in [1, 16, 64]:
+      # build the plans before timing
+      estimator.spectra(bytesToIQ(data[:nBatch]))
+      tStart = time()
+      pTot = np.zeros(nBin)
+      nFrame = 0
+      for i in range(0, nBuffer, nBatch):
+         spectra = estimator.spectra(bytesToIQ(data[i:i + nBatch]))
+         pTot += np.sum(spectra, axis=0)
+         nFrame += spectra.shape[0]
+      tStop = time()
+      printThroughput("Batched "+backend+", "+str(nBatch)+" buffers per FFT call", tStart, tStop)
+
+   # check the agreement with the per-chunk path
+   print("   max relative difference with scipy.signal.welch: "+str(np.max(np.abs(pTot / nFrame / pRef - 1.))))
@@ -0,0 +1,70 @@
+import numpy as np
+from time import time
+
+# Modules from the parent folder
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import iq_sources
+import spectral
+import pfb
+from acquisition import bytesToIQ
+
+
+############################################################
+# 21cm rest-frame frequency
+nu21cm = 1420405751.768 # [Hz]
+
+# Exposure parameters
+nSample = 8192 # samples per buffer
+nBin = 512 # number of freq bins for power spectrum
+sampleRate = 2.32e6 # [Hz]
+nBuffer = 500 # number of buffers to process
+nTap = 4 # PFB taps
+
+
+############################################################
+# Same IQ buffers for both estimators:
+# synthetic noise and 21cm line, plus a strong tone between two bins
+
+source = iq_sources.SyntheticSource(sampleRate, nu21cm, seed=0)
+t = np.arange(nSample) / sampleRate
+fTone = 10.5 * sampleRate / nBin # [Hz] relative to the center frequency
+tone = 0.3 * np.exp(2.j * np.pi * fTone * t).astype(np.complex64)
+buffers = [bytesToIQ(source.readBytes(2 * nSample)) + tone for i in range(nBuffer)]
+
+
+############################################################
+# Throughput
+
+estimators = {'FFT (Welch)': spectral.WelchEstimator(nBin, sampleRate),
+              'PFB '+str(nTap)+' taps': pfb.PfbEstimator(nBin, sampleRate, nTap=nTap)}
+pMean = {}
+
+for name, estimator in estimators.items():
+   pTot = np.zeros(nBin)
+   nFrame = 0
+   tStart = time()
+   for iq in buffers:
+      spectra = estimator.spectra(iq)
+      pTot += np.sum(spectra, axis=0)
+      nFrame += spectra.shape[0]
+   tStop = time()
+   pMean[name] = np.fft.fftshift(pTot / nFrame)
+   print(name+": "+str(round(nBuffer * nSample / (tStop - tStart) / 1.e6, 2))+" MS/s, "
+         +str(round(nBuffer * nSample / (tStop - tStart) / sampleRate, 1))+" times real time")
+
+
+############################################################
+# Leakage of a pure tone halfway between two bins,
+# into the bins 2, 5 and 20 bins away
+
+iTone = nBin // 2 + 10
+for name, estimator in estimators.items():
+   estimator.reset()
+   pTot = np.zeros(nBin)
+   for i in range(10):
+      spectra = estimator.spectra(np.exp(2.j * np.pi * fTone * (t + i * nSample / sampleRate)).astype(np.complex64))
+      pTot += np.sum(spectra, axis=0)
+   p = np.fft.fftshift(pTot)
+   leakage = [str(round(10. * np.log10(p[iTone + d] / p[iTone]), 1)) for d in [2, 5, 20]]
+   print(name+": leakage 2, 5, 20 bins away from the tone is "+", ".join(leakage)+" dB")
@@ -0,0 +1,42 @@
+import numpy as np
+
+# Modules from the parent folder
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import velocity_frames
+
+import astropy.units as u
+from astropy.coordinates import SkyCoord, LSRK
+
+
+############################################################
+# Solar motion with respect to the LSRK, against astropy:
+# a source at rest in the barycentric frame has, in the LSRK frame,
+# the radial velocity vSunLsrk projected on its line of sight
+
+rng = np.random.default_rng(0)
+nCoord = 1000
+ra = rng.uniform(0., 24., nCoord) # [hour]
+dec = np.degrees(np.arcsin(rng.uniform(-1., 1., nCoord))) # [deg]
+
+coord = SkyCoord(ra=ra * 15. * u.deg, dec=dec * u.deg, distance=1. * u.kpc,
+                 pm_ra_cosdec=0. * u.mas / u.yr, pm_dec=0. * u.mas / u.yr,
+                 radial_velocity=0. * u.km / u.s, frame='icrs')
+vAstropy = coord.transform_to(LSRK()).radial_velocity.to_value(u.m / u.s)
+vHere = velocity_frames.vSunLsrk @ coord.cartesian.xyz.value / coord.distance.to_value(u.kpc)
+
+print("Max difference = "+str(np.max(np.abs(vHere - vAstropy)))+" m/s")
+assert np.allclose(vHere, vAstropy, atol=1.)
+
+
+############################################################
+# Full correction, topocentric to LSRK minus topocentric to barycentric
+
+lat, lon = 40., -75. # [deg]
+timeEpoch = 1.76e9 # [sec]
+vLsrk = velocity_frames.getVelocityCorrection(ra, dec, lat, lon, timeEpoch, frame='lsrk')
+vBary = velocity_frames.getVelocityCorrection(ra, dec, lat, lon, timeEpoch, frame='barycentric')
+
+print("Max difference = "+str(np.max(np.abs(vLsrk - vBary - vAstropy)))+" m/s")
+assert np.allclose(vLsrk - vBary, vAstropy, atol=1.)
+print("LSRK velocity corrections agree with astropy")
@@ -0,0 +1,81 @@
+# Spectral estimators turning buffers of IQ samples into power spectra.
+# Each estimator returns the power spectral density of every frame
+# in the buffer, so that buffers of any size can be accumulated exactly,
+# and the frames can be screened for RFI before averaging.
+# - WelchEstimator: Welch periodograms, as computed by rtlobs
+# - pfb.PfbEstimator: polyphase filter bank channelizer
+
+import numpy as np
+import fft_plans
+import pfb
+
+
+def getFrames(iq, nBin):
+   '''Segments of nBin samples overlapping by half,
+   as in the Welch estimator, without copying.
+   For a batch of buffers iq (nBuffer, nSample),
+   returns the segments of each buffer (nBuffer, nFrame, nBin).
+   '''
+   frames = np.lib.stride_tricks.sliding_window_view(iq, nBin, axis=-1)
+   return frames[..., ::nBin // 2, :]
+
+
+def power(x):
+   '''|x|^2 in the precision of x, without a complex temporary.
+   '''
+   return x.real**2 + x.imag**2
+
+
+def welchFrames(frames, window, sampleRate, fft=None):
+   '''Welch power spectra [V^2/Hz] of each frame (last axis),
+   detrended, windowed, unshifted,
+   with a single batched FFT over all frames.
+   '''
+   if fft is None:
+      fft = fft_plans.getFFT()
+   frames = frames - np.mean(frames, axis=-1, keepdims=True)
+   frames *= window
+   spectra = power(fft(frames))
+   spectra /= sampleRate * np.sum(window.astype(np.float64)**2)
+   return spectra
+
+
+class WelchEstimator:
+   '''Welch estimator of the power spectral density [V^2/Hz],
+   with half-overlapping windowed segments of nBin samples,
+   matching scipy.signal.welch as called by rtlobs.
+   '''
+   # every other frame is independent, for the spectral kurtosis
+   skFrameStride = 2
+
+   def __init__(self, nBin, sampleRate, window='hann', fft=None):
+      self.nBin = nBin
+      self.sampleRate = sampleRate
+      self.window = fft_plans.getWindow(window, nBin)
+      self.f = np.fft.fftfreq(nBin, d=1. / sampleRate)
+      self.fft = fft if fft is not None else fft_plans.getFFT()
+
+   def reset(self):
+      pass
+
+   def spectra(self, iq):
+      '''Power spectral densities p [V^2/Hz] of the frames of the buffer iq,
+      or of the batch of buffers iq (nBuffer, nSample),
+      as an array (nFrame, nBin), unshifted.
+      The frequencies [Hz] relative to the center frequency are in self.f.
+      '''
+      spectra = welchFrames(getFrames(iq, self.nBin), self.window, self.sampleRate, fft=self.fft)
+      return spectra.reshape((-1, self.nBin))
+
+
+def getEstimator(param):
+   '''Create the spectral estimator selected by param['estimator']:
+   'welch' or 'pfb', with the FFT backend param['fftBackend'].
+   '''
+   fft = fft_plans.getFFT(param['fftBackend'], param['fftwWisdomFile'], param['fftThreads'])
+   if param['estimator']=='welch':
+      return WelchEstimator(param['nBin'], param['sampleRate'], fft=fft)
+   elif param['estimator']=='pfb':
+      return pfb.PfbEstimator(param['nBin'], param['sampleRate'], nTap=param['pfbTaps'], window=param['pfbWindow'], fft=fft)
+   else:
+      raise ValueError("Unknown spectral estimator "+str(param['estimator']))
@@ -0,0 +1,99 @@
+# Velocity frame corrections for the 21cm spectra.
+# The velocities from the plain Doppler formula are topocentric:
+# they include the rotation of the Earth and its orbit around the Sun,
+# up to ~30 km/s, which shifts the line between exposures and nights.
+# The correction to the barycentric frame, or to the kinematic local standard of rest (LSRK),
+# is computed with astropy, from the pointing, site and time of capture.
+# The site is cached,
+# and a whole session is corrected with a single vectorized transformation.
+# astropy is optional: without it, the correction is nan.
+
+import numpy as np
+from functools import lru_cache
+
+try:
+   import astropy.units as u
+   from astropy.coordinates import SkyCoord, EarthLocation
+   from astropy.time import Time
+except ImportError:
+   u = None
+
+
+# speed of light [m/s]
+c = 299792458
+# 21cm line rest-frame frequency
+nu21cm = 1420405751.768 # [Hz]
+# Velocity [m/s] of the Sun with respect to the LSRK, as ICRS cartesian components:
+# 20 km/s towards RA=18h, Dec=+30deg (B1900), converted to ICRS,
+# the same as V_OFFSET_LSRK in astropy.coordinates.builtin_frames.lsr
+vSunLsrk = np.array([0.28999706839034606, -17.317264789717928, 10.00141199546947]) * 1.e3
+
+# the missing astropy is only reported once
+warnedNoAstropy = False
+
+
+@lru_cache(maxsize=None)
+def getLocation(lat, lon, height=0.):
+   '''Observing site, at latitude lat [deg], longitude lon [deg, East positive]
+   and height [m], built once per site.
+   '''
+   return EarthLocation.from_geodetic(lon=lon * u.deg, lat=lat * u.deg, height=height * u.m)
+
+
+def getVelocityCorrection(ra, dec, lat, lon, timeEpoch, frame='lsrk'):
+   '''Velocity correction [m/s] to add to the topocentric radial velocities,
+   to get them in the frame 'barycentric' or 'lsrk'.
+   ra [hour], as read from INDI, dec [deg], lat, lon [deg], timeEpoch [sec since Unix epoch]:
+   scalars, or arrays for a whole session, all transformed at once.
+   The epoch-of-date coordinates from the mount are used as ICRS,
+   an error well below 0.1 km/s.
+   Returns nan where the pointing or the site is unknown,
+   or everywhere if astropy is not installed.
+   '''
+   global warnedNoAstropy
+   ra, dec, lat, lon, timeEpoch = np.broadcast_arrays(*[np.asarray(x, dtype=np.float64)
+                                                        for x in [ra, dec, lat, lon, timeEpoch]])
+   shape = ra.shape
+   ra, dec, lat, lon, timeEpoch = [x.ravel() for x in [ra, dec, lat, lon, timeEpoch]]
+   if u is None:
+      if not warnedNoAstropy:
+         print("astropy is not installed, no velocity correction")
+         warnedNoAstropy = True
+      return np.full(shape, np.nan)
+
+   vCorrection = np.full(len(ra), np.nan)
+   known = np.isfinite(ra) & np.isfinite(dec) & np.isfinite(lat) & np.isfinite(lon) & np.isfinite(timeEpoch)
+   # one transformation per site, vectorized over the exposures
+   for site in set(zip(lat[known], lon[known])):
+      I = known & (lat==site[0]) & (lon==site[1])
+      coord = SkyCoord(ra=ra[I] * 15. * u.deg, dec=dec[I] * u.deg, frame='icrs')
+      obstime = Time(timeEpoch[I], format='unix')
+      v = coord.radial_velocity_correction(kind='barycentric', obstime=obstime,
+                                           location=getLocation(*site)).to_value(u.m / u.s)
+      if frame=='lsrk':
+         # project the solar motion on the line of sight
+         n = coord.cartesian.xyz.value # (3, nExposure)
+         v = v + vSunLsrk @ n
+      elif frame!='barycentric':
+         raise ValueError("Unknown velocity frame "+str(frame))
+      vCorrection[I] = v
+   return vCorrection.reshape(shape)
+
+
+def getRadioVelocity(f):
+   '''Radial velocity [m/s] of the 21cm line at frequency f [Hz],
+   radio convention, positive when receding.
+   '''
+   return c * (nu21cm - np.asarray(f)) / nu21cm
+
+
+def shiftFrequencies(f, vCorrection):
+   '''Frequencies f [Hz], (nBin,) or (nExposure, nBin),
+   shifted so that the 21cm line at a given frame velocity
+   lands at the same frequency in all exposures.
+   vCorrection [m/s] is a scalar or an array (nExposure,).
+   '''
+   vCorrection = np.asarray(vCorrection)
+   if vCorrection.ndim==1:
+      vCorrection = vCorrection[:, np.newaxis]
+   return np.asarray(f) - nu21cm * vCorrection / c
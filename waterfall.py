@@ -0,0 +1,122 @@
+# Append-only waterfall of the spectra of an observing session.
+# Each exposure appends one row of nBin channels to a raw binary file,
+# and one record (time, pointing) to a parallel table,
+# so that a whole night can be memory-mapped as a single (nTime, nBin) array,
+# without parsing any exposure file.
+# Files, for a session stem such as ./output/20250525/20250525_waterfall_on:
+# - stem.json: header with the frequencies [Hz], nBin and dtypes
+# - stem.dat: the spectra, one row per exposure
+# - stem_times.dat: the time/pointing table, one record per exposure
+# If the frequencies change during the session, e.g. a new centerFrequency,
+# the new spectra go to another waterfall, stem_<hash of the frequencies>.
+
+import numpy as np
+import os
+import json_io
+import npz_io
+
+
+# dtype of the spectra
+dtype = np.dtype('<f8')
+
+# fields of the time/pointing table
+tableFields = ['timeEpoch', # [sec] since the Unix epoch
+               'hourCapture', # [hour] since midnight of the session start date
+               'integrationTime', # [sec]
+               'ra', # [hour], as read from INDI
+               'dec', # [deg]
+               'lat', # [deg]
+               'lon'] # [deg]
+tableDtype = np.dtype([(name, '<f8') for name in tableFields])
+
+
+def getPaths(pathStem):
+   return pathStem+'.json', pathStem+'.dat', pathStem+'_times.dat'
+
+
+def getStem(pathStem, f):
+   '''Stem of the waterfall for the spectra at frequencies f [Hz]:
+   pathStem, unless it already holds spectra at other frequencies,
+   in which case pathStem_<hash of f>, see npz_io.getAxisHash.
+   '''
+   pathHeader = getPaths(pathStem)[0]
+   if not os.path.exists(pathHeader):
+      return pathStem
+   fWaterfall = np.asarray(json_io.loadJson(pathHeader)['f'])
+   if npz_io.getAxisHash(f)==npz_io.getAxisHash(fWaterfall):
+      return pathStem
+   return pathStem+'_'+npz_io.getAxisHash(f)
+
+
+class Waterfall:
+   '''Writer of the waterfall pathStem.
+   If the waterfall already exists, new rows are appended to it,
+   provided the frequencies match.
+   '''
+   def __init__(self, pathStem):
+      self.pathStem = pathStem
+      self.pathHeader, self.pathData, self.pathTable = getPaths(pathStem)
+      if os.path.exists(self.pathHeader):
+         self.f = np.asarray(json_io.loadJson(self.pathHeader)['f'])
+         self.repair()
+      else:
+         self.f = None
+
+   def repair(self):
+      '''Truncate both files to their common number of complete rows,
+      in case a previous append was interrupted.
+      '''
+      nTime = getNTime(self.pathStem)
+      for path, rowSize in [(self.pathData, len(self.f) * dtype.itemsize),
+                            (self.pathTable, tableDtype.itemsize)]:
+         if os.path.exists(path) and os.path.getsize(path)!=nTime * rowSize:
+            with open(path, 'r+b') as file:
+               file.truncate(nTime * rowSize)
+
+   def append(self, f, p, record):
+      '''Append the spectrum p [au] at frequencies f [Hz],
+      and its record, a dict with the keys of tableFields.
+      '''
+      if self.f is None:
+         self.f = np.array(f, dtype=np.float64)
+         header = {'f': self.f, 'nBin': len(self.f), 'dtype': dtype.str, 'tableFields': tableFields}
+         json_io.saveJson(header, self.pathHeader)
+      elif npz_io.getAxisHash(f)!=npz_io.getAxisHash(self.f):
+         raise ValueError("Frequencies differ from those of the waterfall "+self.pathStem)
+
+      # spectrum first, then its record,
+      # so that readers never see a record without its spectrum
+      with open(self.pathData, 'ab') as file:
+         file.write(np.asarray(p, dtype=dtype).tobytes())
+      row = np.zeros(1, dtype=tableDtype)
+      for name in tableFields:
+         row[name] = np.nan if record.get(name) is None else record[name]
+      with open(self.pathTable, 'ab') as file:
+         file.write(row.tobytes())
+
+
+def getNTime(pathStem):
+   '''Number of complete rows of the waterfall.
+   '''
+   pathHeader, pathData, pathTable = getPaths(pathStem)
+   nBin = json_io.loadJson(pathHeader)['nBin']
+   nData = os.path.getsize(pathData) // (nBin * dtype.itemsize) if os.path.exists(pathData) else 0
+   nTable = os.path.getsize(pathTable) // tableDtype.itemsize if os.path.exists(pathTable) else 0
+   return min(nData, nTable)
+
+
+def loadWaterfall(pathStem):
+   '''Memory-map the waterfall pathStem, read-only.
+   Returns the frequencies f [Hz] (nBin,),
+   the spectra p (nTime, nBin), and the time/pointing table (nTime,),
+   a numpy record array with the fields tableFields, e.g. table['timeEpoch'].
+   Rows appended after this call are not included.
+   '''
+   pathHeader, pathData, pathTable = getPaths(pathStem)
+   f = np.asarray(json_io.loadJson(pathHeader)['f'])
+   nTime = getNTime(pathStem)
+   if nTime==0:
+      return f, np.zeros((0, len(f)), dtype=dtype), np.zeros(0, dtype=tableDtype)
+   p = np.memmap(pathData, dtype=dtype, mode='r', shape=(nTime, len(f)))
+   table = np.memmap(pathTable, dtype=tableDtype, mode='r', shape=(nTime,))
+   return f, p, table
@@ -0,0 +1,71 @@
+# Frequency-hopping wideband spectra.
+# The tuner cycles across N overlapping center frequencies,
+# and the sub-spectra are stitched into one wide spectrum,
+# matching the gains of neighbouring segments in their overlap,
+# and cross-fading them with linear weights.
+
+import numpy as np
+
+
+def getHopFrequencies(param):
+   '''Center frequencies [Hz] of the param['nHop'] hops,
+   symmetric around param['centerFrequency'],
+   overlapping by a fraction param['hopOverlap'] of the bandwidth.
+   The step is a whole number of frequency bins,
+   so that all sub-spectra fall on a common frequency grid.
+   '''
+   nOverlap = getNOverlap(param)
+   df = param['sampleRate'] / param['nBin']
+   step = (param['nBin'] - nOverlap) * df
+   return param['centerFrequency'] + (np.arange(param['nHop']) - (param['nHop'] - 1) / 2.) * step
+
+
+def getNOverlap(param):
+   '''Number of frequency bins shared by neighbouring hops.
+   '''
+   return int(round(param['hopOverlap'] * param['nBin']))
+
+
+def stitchSpectra(fHops, pHops, nOverlap):
+   '''Stitch the sub-spectra pHops [any unit], one row per hop,
+   with frequencies fHops [Hz] on a common grid, in increasing order,
+   and neighbours sharing nOverlap bins.
+   Each hop is rescaled to match its neighbour closer to the middle hop,
+   using the median ratio in their overlap.
+   Overlapping bins are then averaged with weights ramping linearly
+   from 0 to 1 over the nOverlap bins at each edge of each hop.
+   Returns f [Hz], p [same unit as pHops] and the gain of each hop.
+   '''
+   nHop, nBin = pHops.shape
+   df = fHops[0, 1] - fHops[0, 0]
+   # offset of each hop on the common grid, in bins
+   offsets = np.round((fHops[:, 0] - fHops[0, 0]) / df).astype(int)
+   nChannel = offsets[-1] + nBin
+   f = fHops[0, 0] + df * np.arange(nChannel)
+
+   # Gain matching, chained outwards from the middle hop
+   gains = np.ones(nHop)
+   iRef = nHop // 2
+   for i in list(range(iRef + 1, nHop)) + list(range(iRef - 1, -1, -1)):
+      # neighbour closer to the middle hop
+      j = i - 1 if i > iRef else i + 1
+      # overlap on the common grid
+      start = max(offsets[i], offsets[j])
+      stop = min(offsets[i], offsets[j]) + nBin
+      if stop <= start:
+         continue
+      ratio = pHops[j, start - offsets[j]:stop - offsets[j]] / pHops[i, start - offsets[i]:stop - offsets[i]]
+      gains[i] = gains[j] * np.median(ratio)
+
+   # Linear cross-fade weights over the overlaps
+   ramp = np.minimum(1., (np.arange(nBin) + 0.5) / max(nOverlap, 1))
+   weight = np.minimum(ramp, ramp[::-1])
+
+   pSum = np.zeros(nChannel)
+   weightSum = np.zeros(nChannel)
+   for i in range(nHop):
+      pSum[offsets[i]:offsets[i] + nBin] += weight * gains[i] * pHops[i]
+      weightSum[offsets[i]:offsets[i] + nBin] += weight
+   p = pSum / weightSum
+
+   return f, p, gains